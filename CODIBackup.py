@@ -1,16 +1,42 @@
 #!/usr/bin/env python3
 
 import json
+import sys
+import copy
 import hashlib
 import os
 from datetime import datetime, timezone, timedelta
 import shutil
+import tarfile
 from argparse import ArgumentParser
 from codi.io import Path, File
+from codi.index import PathIndex
+from codi.catalog import Catalog, CatalogBackup, fileEntry
+from codi.journal import Journal
+from codi.ignore import IgnoreMatcher
+from codi.chunker import Chunker
+from codi.codec import CODECS, available, compress, worthCompressing, Decompressor
+from codi.pack import PackWriter
+from codi.target import TARGET
+from codi.throttle import TokenBucket, THROTTLE, lowerPriority
+from codi.checkpoint import Checkpoint
+from codi.snapshot import SnapshotView, partBlocks
+from codi.inotify import Inotify, IN_CHANGES, IN_ONLYDIR, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR, IN_CREATE, IN_MOVED_TO
+import time
+import random
+import heapq
+from bisect import bisect_right
+from collections import deque
+from queue import Queue
 from logging import getLogger, DEBUG, FileHandler, StreamHandler, Formatter, INFO
-from pathlib import PurePath
 import traceback
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, Future
+import concurrent.futures
+from threading import BoundedSemaphore, Thread, Lock
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+import socket
+import fcntl
 
 __version__ = "0.1.0"
 
@@ -32,8 +58,18 @@ logger.addHandler(ch)
 
 VERBOSE = True
 BACKUPS = []
+INDEX = PathIndex()
+CATALOG = None
+JOURNAL = None
+LOCKFD = None
 CONFIG = {}
+IGNORE = None
 BACKUPROOT = None
+STATEFILE = "CODIBackup_state.json"
+OBJECTSTORE = False
+LEGACY = set()
+OBJECTS = "objects"
+PACKS = "CODIBackup_packs"
 
 
 class BackupType(str, Enum):
@@ -46,426 +82,1591 @@ class BackupType(str, Enum):
 	Base = "Base"
 
 
-def peek(timestring):
-	timestamp = datetime.strptime(timestring, "%Y%m%dT%H%M%S")
-	relevant = False
-	folderStructure = {"files": {}, "folders": {}}
-	for backup in BACKUPS:
-		if not relevant:
-			created = backup["created"]
-			ts = datetime.strptime(created, "%Y%m%dT%H%M%S")
-			if ts <= timestamp:
-				relevant = True
-		if relevant:
-			for file in backup["files"].keys():
-				if file not in folderStructure["files"].keys():
-					if backup["files"][file]["hash"] != "":
-						folderStructure["files"][file] = backup["created"] + file
-					else:
-						folderStructure["files"][file] = ""
-			for folder in backup["folders"].keys():
-				if folder not in folderStructure["folders"].keys():
-					if backup["folders"][folder]:
-						folderStructure["folders"][folder] = folder
-	return folderStructure
-
-
-def recover(timestring, toBeRecovered=None):
-	folderStructure = peek(timestring)
-	for file in folderStructure["files"].keys():
-		if file != "":
-			extract = False
-			if toBeRecovered is not None:
-				if file.startswith(toBeRecovered):
-					extract = True
+TIMEFORMAT = "%Y%m%dT%H%M%S"
+TIERS = [BackupType.Minute, BackupType.Hour, BackupType.Day, BackupType.Week, BackupType.Month, BackupType.Year, BackupType.Base]
+# backups of a type are merged while the newer one was edited within this time after the older one was created
+MERGEWINDOWS = {
+    BackupType.Hour: timedelta(minutes=59),
+    BackupType.Day: timedelta(hours=23, minutes=59),
+    BackupType.Week: timedelta(days=6, hours=23, minutes=59),
+    BackupType.Month: timedelta(days=27, hours=23, minutes=59),
+    BackupType.Year: timedelta(days=28 * 12 - 1, hours=23, minutes=59),
+    BackupType.Base: None
+}
+
+
+class BackupPipeline():
+	def __init__(self, backupPath):
+		self.backupPath = backupPath
+		self.bufferSize = CONFIG.get("bufferSize", 1024 * 1024)
+		hashWorkers = CONFIG.get("hashWorkers", 4)
+		copyWorkers = CONFIG.get("copyWorkers", 2)
+		self.hashPool = ThreadPoolExecutor(max_workers=hashWorkers)
+		self.copyPool = ThreadPoolExecutor(max_workers=copyWorkers)
+		self.hashSlots = BoundedSemaphore(hashWorkers * 4)
+		self.copySlots = BoundedSemaphore(copyWorkers * 4)
+		self.pending = []
+		# large files are split into chunks in the object store, so a small change only stores the changed chunks
+		self.chunker = None
+		self.chunkThreshold = CONFIG.get("chunkThreshold", 64 * 1024 * 1024)
+		if OBJECTSTORE and CONFIG.get("chunking", False):
+			self.chunker = Chunker(CONFIG.get("chunkSize", 1024 * 1024))
+		self.codec = CONFIG.get("compression") or None
+		self.level = CONFIG.get("compressionLevel")
+		if self.codec is not None and not available(self.codec):
+			logger.error("compression " + str(self.codec) + " is not available, storing uncompressed")
+			self.codec = None
+		# small files are appended to a few pack files instead of creating a file each
+		self.packs = None
+		self.packThreshold = CONFIG.get("packThreshold", 64 * 1024)
+		if not OBJECTSTORE and CONFIG.get("packing", False):
+			self.packs = PackWriter(backupPath.join(PACKS, True), CONFIG.get("packSize", 64 * 1024 * 1024))
+		# finished files are recorded every checkpointInterval seconds, so a crashed backup does not start over
+		self.checkpoint = Checkpoint(backupPath)
+		self.checkpointInterval = CONFIG.get("checkpointInterval", 300)
+		self.checkpointed = time.monotonic()
+		self.resumed = self.checkpoint.read()
+		self.checkpoint.create()
+
+	def fork(self, hashPool, hashSlots, copyPool, copySlots):
+		# a pipeline for walking one root that shares everything but the workers reading its device and the pending files
+		lane = copy.copy(self)
+		lane.hashPool = hashPool
+		lane.hashSlots = hashSlots
+		lane.copyPool = copyPool
+		lane.copySlots = copySlots
+		lane.pending = []
+		lane.checkpointed = time.monotonic()
+		return lane
+
+	def submit(self, src, indexed):
+		self.hashSlots.acquire()
+		try:
+			future = self.hashPool.submit(self.hash, src, indexed)
+		except BaseException:
+			self.hashSlots.release()
+			raise
+		self.pending.append((src, future))
+
+	def hash(self, src, indexed):
+		try:
+			storedHash = ""
+			if indexed is not None:
+				storedHash = indexed["hash"]
+				# same size: most likely just touched, so hash before writing anything
+				if storedHash != "" and indexed.get("size", src.size) == src.size and "chunks" not in indexed:
+					if src.sha256(self.bufferSize) == storedHash:
+						return None
+			if self.chunker is not None and src.size >= self.chunkThreshold:
+				done = Future()
+				done.set_result(self.chunk(src, storedHash))
+				return done
+			self.copySlots.acquire()
+			try:
+				return self.copyPool.submit(self.copy, src, storedHash)
+			except BaseException:
+				self.copySlots.release()
+				raise
+		finally:
+			self.hashSlots.release()
+
+	def copy(self, src, storedHash):
+		# returns (hash, changed, the entry fields describing how it is stored)
+		try:
+			if self.packs is not None and src.size < self.packThreshold:
+				return self.pack(src, storedHash)
+			if OBJECTSTORE:
+				dst = newObjectPath
+				tmpDir = BACKUPROOT.join(OBJECTS, True)
 			else:
-				extract = True
-			if extract:
-				tmp = file[file.find(os.sep) + 1:]
-				tmp = tmp.replace(os.sep, "/")
-				backupPath = BACKUPROOT.join(folderStructure["files"][file], False)
-				originalPath = Path(file, False)
-				backupPath.cp(originalPath)
-				if VERBOSE:
-					logger.info("extracting " + file)
-					logger.debug(folderStructure["files"][file])
-	for folder in folderStructure["folders"].keys():
-		extract = False
-		if toBeRecovered is not None:
-			if folder.startswith(toBeRecovered):
-				extract = True
+				dst = self.backupPath.join(src.path, False)
+				tmpDir = None
+			calculatedHash, copied, codec, storedSize = src.cpHashed(dst, self.bufferSize, storedHash, tmpDir, self.codec, self.level)
+			return calculatedHash, copied, storedFields(codec=codec, storedSize=storedSize)
+		finally:
+			self.copySlots.release()
+
+	def pack(self, src, storedHash):
+		with open(src.path, "rb") as fd:
+			data = fd.read()
+		THROTTLE.reading(len(data))
+		calculatedHash = hashlib.sha256(data).hexdigest()
+		if calculatedHash == storedHash:
+			return calculatedHash, False, {}
+		codec = None
+		if self.codec is not None and worthCompressing(self.codec, data[:self.bufferSize], self.level):
+			codec = self.codec
+			data = compress(codec, data, self.level)
+		THROTTLE.writing(len(data))
+		pack, packOffset = self.packs.append(data)
+		return calculatedHash, True, storedFields(codec=codec, storedSize=len(data), pack=pack, packOffset=packOffset)
+
+	def chunk(self, src, storedHash):
+		# stores the chunks that are not stored yet, returns (hash, changed, entry fields) like copy
+		sha256 = hashlib.sha256()
+		chunks = []
+		storedSize = 0
+		with open(src.path, "rb") as fd:
+			for data in self.chunker.chunks(fd, self.bufferSize):
+				THROTTLE.reading(len(data))
+				sha256.update(data)
+				chunkHash = hashlib.sha256(data).hexdigest()
+				existing = existingObject(chunkHash)
+				if existing is None:
+					codec = None
+					if self.codec is not None and worthCompressing(self.codec, data[:self.bufferSize], self.level):
+						codec = self.codec
+						data = compress(codec, data, self.level)
+					chunkPath = objectPath(objectName(chunkHash, codec))
+					THROTTLE.writing(len(data))
+					chunkPath.writeAtomic(data, BACKUPROOT.join(OBJECTS, True))
+					storedSize += len(data)
+				else:
+					chunkPath, codec = existing
+					storedSize += chunkPath.getsize()
+				chunks.append(objectName(chunkHash, codec))
+		calculatedHash = sha256.hexdigest()
+		return calculatedHash, calculatedHash != storedHash, storedFields(storedSize=storedSize, chunks=chunks)
+
+	def finish(self, currentBackup):
+		# the last copies may take long, checkpoints are saved while waiting for them
+		while True:
+			deadline = self.checkpointed + self.checkpointInterval
+			if len(concurrent.futures.wait([future for src, future in self.pending], max(deadline - time.monotonic(), 0)).not_done) == 0:
+				copies = [future.result() for src, future in self.pending if future.result() is not None]
+				if len(concurrent.futures.wait(copies, max(deadline - time.monotonic(), 0)).not_done) == 0:
+					break
+			self.save(currentBackup)
+		self.collect(currentBackup, True)
+
+	def collect(self, currentBackup, wait):
+		# moves the results of finished files into currentBackup in the order they were submitted, returns the new entries
+		ret = []
+		done = 0
+		for src, future in self.pending:
+			if not wait and not future.done():
+				break
+			copyFuture = future.result()
+			if copyFuture is not None:
+				if not wait and not copyFuture.done():
+					break
+				calculatedHash, copied, fields = copyFuture.result()
+				if copied:
+					entry = fileEntry(calculatedHash, src.getmtime().strftime("%Y%m%dT%H%M%S"), src.size, src.mtime)
+					entry.update(fields)
+					currentBackup["files"][src.path] = entry
+					ret.append((src.path, entry))
+					if VERBOSE:
+						logger.info("backing up " + src.path)
+			done += 1
+		del self.pending[:done]
+		return ret
+
+	def save(self, currentBackup):
+		if time.monotonic() - self.checkpointed < self.checkpointInterval:
+			return
+		self.checkpointed = time.monotonic()
+		entries = self.collect(currentBackup, False)
+		# the checkpoint must not reference data that is not on the target yet
+		if self.packs is not None:
+			self.packs.sync()
+		TARGET.barrier()
+		self.checkpoint.append(entries)
+		if VERBOSE and len(entries) > 0:
+			logger.info("checkpoint of " + currentBackup["created"] + " with " + str(len(entries)) + " more files")
+
+	def close(self):
+		self.hashPool.shutdown(wait=True, cancel_futures=True)
+		self.copyPool.shutdown(wait=True, cancel_futures=True)
+		if self.packs is not None:
+			self.packs.close()
+		self.checkpoint.close()
+
+
+def storedFields(**fields):
+	return {key: value for key, value in fields.items() if value is not None}
+
+
+def objectName(digest, codec=None):
+	# compressed objects carry their codec as suffix
+	if codec is None:
+		return digest
+	return digest + "." + codec
+
+
+def objectCodec(name):
+	if "." in name:
+		return name.split(".", 1)[1]
+	return None
+
+
+def objectPath(name):
+	return BACKUPROOT.join(OBJECTS + "/" + name[:2] + "/" + name[2:], False)
+
+
+def existingObject(digest):
+	# (path, codec) of the object storing digest in any codec, None if it is not stored
+	for codec in [None] + CODECS:
+		path = objectPath(objectName(digest, codec))
+		if path.exists():
+			return path, codec
+	return None
+
+
+def newObjectPath(digest, codec=None):
+	existing = existingObject(digest)
+	if existing is not None:
+		return existing
+	return objectPath(objectName(digest, codec)), codec
+
+
+def storedName(created, file, entry):
+	if "pack" in entry:
+		return created + "/" + PACKS + "/" + entry["pack"]
+	if inObjects(created):
+		name = objectName(entry["hash"], entry.get("codec"))
+		return OBJECTS + "/" + name[:2] + "/" + name[2:]
+	return created + file
+
+
+def inObjects(created):
+	# backups from before the object store was enabled keep their own files until a backup run migrates them
+	return OBJECTSTORE and created not in LEGACY
+
+
+def isBackupName(name):
+	try:
+		datetime.strptime(name.rstrip(os.sep), "%Y%m%dT%H%M%S")
+	except ValueError:
+		return False
+	return True
+
+
+def backupAt(timestring, catalog=None):
+	# created of the newest backup at or before timestring, None if there is none
+	if catalog is None:
+		catalog = CATALOG
+	return catalog.backupAt(datetime.strptime(timestring, TIMEFORMAT).strftime(TIMEFORMAT))
+
+
+def snapshotFiles(created, prefix=None, catalog=None):
+	# newest entry (with its backup) of every file up to backup created ordered by path, deleted files have an empty hash
+	if catalog is None:
+		catalog = CATALOG
+	for file, entry, backup in catalog.latestFiles(created, prefix):
+		entry["backup"] = backup
+		yield file, entry
+
+
+def snapshotFolders(created, prefix=None, catalog=None):
+	if catalog is None:
+		catalog = CATALOG
+	for folder, exists, backup in catalog.latestFolders(created, prefix):
+		if exists:
+			yield folder
+
+
+def snapshot(timestring, prefix=None):
+	created = backupAt(timestring)
+	if created is None:
+		return {}, []
+	return dict(snapshotFiles(created, prefix)), list(snapshotFolders(created, prefix))
+
+
+def snapshotItems(timestring, prefix=None, catalog=None):
+	# the snapshot streamed as [file, entry] with the stored name, which only the backup layout tells, and [folder, None]
+	created = backupAt(timestring, catalog)
+	if created is None:
+		return
+	for file, entry in snapshotFiles(created, prefix, catalog):
+		if entry["hash"] != "" and "chunks" not in entry:
+			entry["storedName"] = storedName(entry["backup"], file, entry)
+		yield file, entry
+	for folder in snapshotFolders(created, prefix, catalog):
+		yield folder, None
+
+
+def peek(timestring, prefix=None, catalog=None):
+	# stored name of every file existing at timestring, streamed in path order
+	created = backupAt(timestring, catalog)
+	if created is None:
+		return
+	for file, entry in snapshotFiles(created, prefix, catalog):
+		if "chunks" in entry:
+			yield " ".join(OBJECTS + "/" + chunk[:2] + "/" + chunk[2:] for chunk in entry["chunks"])
+		elif "pack" in entry:
+			yield storedName(entry["backup"], file, entry) + ":" + str(entry["packOffset"]) + ":" + str(entry["storedSize"])
+		elif entry["hash"] != "":
+			yield storedName(entry["backup"], file, entry)
+
+
+def diff(older, newer, prefix=None, catalog=None):
+	# (status, path, size change) of every file and folder that differs between the states at both times, streamed in path order;
+	# only the rows of the backups in between are read, so the cost follows the number of changes and not the size of the tree
+	if catalog is None:
+		catalog = CATALOG
+	before = backupAt(older, catalog) or ""
+	after = backupAt(newer, catalog) or ""
+	if before > after:
+		before, after = after, before
+	if before == after:
+		return
+	yield from heapq.merge(diffFiles(catalog, before, after, prefix), diffFolders(catalog, before, after, prefix), key=lambda item: item[1])
+
+
+def diffFiles(catalog, before, after, prefix):
+	for file, entry, backup in catalog.changedFiles(before, after, prefix):
+		latest = catalog.latestFile(file, before)
+		old = None if latest is None or latest[0]["hash"] == "" else latest[0]
+		new = None if entry["hash"] == "" else entry
+		if old is None and new is not None:
+			yield "A", file, sizeChange(None, new)
+		elif old is not None and new is None:
+			yield "D", file, sizeChange(old, None)
+		elif old is not None and old["hash"] != new["hash"]:
+			yield "M", file, sizeChange(old, new)
+
+
+def diffFolders(catalog, before, after, prefix):
+	for folder, present, backup in catalog.changedFolders(before, after, prefix):
+		latest = catalog.latestFolder(folder, before)
+		existed = latest is not None and latest[0]
+		if existed != bool(present):
+			yield "A" if present else "D", folder, None
+
+
+def sizeChange(old, new):
+	# None if the size of a legacy entry is unknown
+	oldSize = 0 if old is None else old.get("size")
+	newSize = 0 if new is None else new.get("size")
+	if oldSize is None or newSize is None:
+		return None
+	return newSize - oldSize
+
+
+def diffLine(status, path, change):
+	if change is None:
+		return status + " " + path
+	return status + " " + ("%+d" % change) + " " + path
+
+
+class RecoverStats():
+	def __init__(self, total):
+		self.lock = Lock()
+		self.total = total
+		self.files = 0
+		self.copied = 0
+		self.skipped = 0
+		self.failed = 0
+		self.bytes = 0
+		self.started = time.monotonic()
+		self.reported = self.started
+
+	def add(self, copiedBytes=None, failed=False):
+		with self.lock:
+			self.files += 1
+			if failed:
+				self.failed += 1
+			elif copiedBytes is None:
+				self.skipped += 1
+			else:
+				self.copied += 1
+				self.bytes += copiedBytes
+
+	def report(self, force=False):
+		now = time.monotonic()
+		if not force and now - self.reported < 5:
+			return
+		self.reported = now
+		elapsed = max(now - self.started, 0.001)
+		logger.info("recovered " + str(self.files) + "/" + str(self.total) + " files (" + str(self.copied) + " copied, " + str(self.skipped) +
+		            " unchanged, " + str(self.failed) + " failed), " + str(self.bytes // (1024 * 1024)) + " MiB, " + str(int(self.files / elapsed)) +
+		            " files/s, " + str(int(self.bytes / elapsed / 1024 / 1024)) + " MiB/s")
+
+
+def recoverFile(file, entry, stats):
+	try:
+		originalPath = Path(file, False)
+		try:
+			stat = os.stat(originalPath.path)
+		except FileNotFoundError:
+			stat = None
+		if stat is not None and entry.get("size") == stat.st_size:
+			if entry.get("mtime") == stat.st_mtime_ns or originalPath.sha256(CONFIG.get("bufferSize", 1024 * 1024)) == entry["hash"]:
+				stats.add()
+				return
+		if "chunks" in entry:
+			originalPath.assemble([(objectPath(chunk), objectCodec(chunk)) for chunk in entry["chunks"]])
 		else:
-			extract = True
-		if extract:
-			if not os.path.isdir(folder):
-				os.makedirs(folder)
+			stored = entry.get("storedName")
+			if stored is None:
+				stored = storedName(entry["backup"], file, entry)
+			if "pack" in entry:
+				originalPath.writeAtomic(readPacked(stored, entry))
+			else:
+				BACKUPROOT.join(stored, False).cpFast(originalPath, entry.get("codec"))
+		if "mtime" in entry:
+			os.utime(originalPath.path, ns=(entry["mtime"], entry["mtime"]))
+		stats.add(originalPath.getsize())
+		if VERBOSE:
+			logger.info("extracting " + file)
+	except OSError:
+		logger.error("could not recover " + file + "\n" + traceback.format_exc())
+		stats.add(failed=True)
+
+
+def readPacked(stored, entry):
+	data = BACKUPROOT.join(stored, False).readAt(entry["packOffset"], entry["storedSize"])
+	if "codec" in entry:
+		decompressor = Decompressor(entry["codec"])
+		data = decompressor.decompress(data) + decompressor.flush()
+	return data
+
+
+def storedParts(file, entry):
+	# where the content of a file of a backup is stored as [(path, codec, offset, size)], offset and size are None for whole files
+	if "chunks" in entry:
+		return [(objectPath(chunk), objectCodec(chunk), None, None) for chunk in entry["chunks"]]
+	stored = BACKUPROOT.join(storedName(entry["backup"], file, entry), False)
+	if "pack" in entry:
+		return [(stored, entry.get("codec"), entry["packOffset"], entry["storedSize"])]
+	return [(stored, entry.get("codec"), None, None)]
+
+
+def snapshotView(timestring):
+	created = backupAt(timestring)
+	if created is None:
+		return None
+	return SnapshotView(CATALOG, created, storedParts)
+
+
+def tarInfo(name, entry, created):
+	info = tarfile.TarInfo(name.strip("/"))
+	info.mtime = datetime.strptime(created, TIMEFORMAT).timestamp()
+	if entry is None:
+		info.type = tarfile.DIRTYPE
+		info.mode = 0o755
+		return info
+	info.mode = 0o644
+	if "mtime" in entry:
+		info.mtime = entry["mtime"] / 1000000000
+	elif entry.get("edited"):
+		info.mtime = datetime.strptime(entry["edited"], TIMEFORMAT).timestamp()
+	if "size" in entry:
+		info.size = entry["size"]
+	else:
+		info.size = BACKUPROOT.join(storedName(entry["backup"], name, entry), False).getsize()
+	return info
+
+
+class QueueReader():
+	# file object for tarfile reading the blocks of one file from the queue of the reading thread
+	def __init__(self, queue):
+		self.queue = queue
+		self.data = b""
+
+	def read(self, size=-1):
+		while len(self.data) < size:
+			block = self.queue.get()
+			if isinstance(block, BaseException):
+				raise block
+			self.data = block if len(self.data) == 0 else self.data + block
+		if len(self.data) == size:
+			ret = self.data
+			self.data = b""
+			return ret
+		ret = self.data[:size]
+		self.data = self.data[size:]
+		return ret
+
+
+def export(timestring, prefix=None, output=None, compression=None):
+	# streams the state at timestring as tar; a thread reads the stored files ahead into a bounded queue,
+	# so reading, compressing and writing overlap and memory does not grow with the size of the snapshot
+	created = backupAt(timestring)
+	if created is None:
+		logger.error("no backup at " + timestring)
+		return
+	bufferSize = CONFIG.get("bufferSize", 1024 * 1024)
+	blocks = Queue(max(CONFIG.get("exportReadahead", 64 * 1024 * 1024) // bufferSize, 2))
+	done = object()
+
+	def emit(file, entry, info):
+		# the tar header promises info.size bytes, so a damaged stored file is cut or padded
+		blocks.put(info)
+		left = info.size
+		try:
+			for data in partBlocks(storedParts(file, entry), bufferSize):
+				data = data[:left]
+				left -= len(data)
+				if len(data) > 0:
+					blocks.put(data)
+		except OSError:
+			logger.error("could not read " + file + "\n" + traceback.format_exc())
+		if left > 0:
+			logger.error(file + " is " + str(left) + " bytes shorter than in the backup, padding it with zeros")
+			blocks.put(bytes(left))
+
+	def read():
+		try:
+			for folder in snapshotFolders(created, prefix):
+				if folder != os.sep:
+					blocks.put(tarInfo(folder, None, created))
+			pending = deque()
+			for file, entry in snapshotFiles(created, prefix):
+				if entry["hash"] == "":
+					continue
+				pending.append((file, entry, tarInfo(file, entry, created)))
+				if "chunks" not in entry and "pack" not in entry:
+					try:
+						BACKUPROOT.join(storedName(entry["backup"], file, entry), False).willNeed()
+					except OSError:
+						pass
+				if len(pending) > 16:
+					emit(*pending.popleft())
+			while len(pending) > 0:
+				emit(*pending.popleft())
+			blocks.put(done)
+		except BaseException as e:
+			blocks.put(e)
+
+	fd = sys.stdout.buffer if output is None or output == "-" else open(output, "wb")
+	reader = Thread(target=read, daemon=True)
+	reader.start()
+	try:
+		with tarfile.open(fileobj=fd, mode="w|" + (compression or ""), bufsize=bufferSize, copybufsize=bufferSize) as tar:
+			while True:
+				item = blocks.get()
+				if item is done:
+					break
+				if isinstance(item, BaseException):
+					raise item
+				if item.isdir():
+					tar.addfile(item)
+				else:
+					tar.addfile(item, QueueReader(blocks))
+					if VERBOSE:
+						logger.info("exporting /" + item.name)
+				# written members are not needed again, keeping them would grow with the snapshot
+				tar.members.clear()
+	finally:
+		if fd is not sys.stdout.buffer:
+			fd.close()
+
+
+def recover(timestring, toBeRecovered=None, state=None):
+	if state is None:
+		state = snapshot(timestring, toBeRecovered)
+	files, folders = state
+	selected = [(file, entry) for file, entry in files.items() if entry["hash"] != ""]
+	folders = set(folders)
+	for file, entry in selected:
+		folders.add(os.path.dirname(file) + os.sep)
+	for folder in sorted(folders):
+		os.makedirs(folder, exist_ok=True)
+
+	stats = RecoverStats(len(selected))
+	workers = CONFIG.get("recoverWorkers", 4)
+	slots = BoundedSemaphore(workers * 4)
+
+	def work(file, entry):
+		try:
+			recoverFile(file, entry, stats)
+		finally:
+			slots.release()
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for file, entry in selected:
+			slots.acquire()
+			pool.submit(work, file, entry)
+			if VERBOSE:
+				stats.report()
+	stats.report(True)
+
+
+def storedItems(created, file, entry):
+	# (key, path, codec, hash, offset, size) of every stored item holding entry, offset and size are None for whole files
+	if "chunks" in entry:
+		ret = []
+		for chunk in entry["chunks"]:
+			key = OBJECTS + "/" + chunk[:2] + "/" + chunk[2:]
+			ret.append((key, key, objectCodec(chunk), chunk.split(".", 1)[0], None, None))
+		return ret
+	stored = storedName(created, file, entry)
+	if "pack" in entry:
+		return [(stored + ":" + str(entry["packOffset"]), stored, entry.get("codec"), entry["hash"], entry["packOffset"], entry["storedSize"])]
+	return [(stored, stored, entry.get("codec"), entry["hash"], None, None)]
+
+
+def verifyItem(item, bucket):
+	# returns the problem of a stored item (None, "missing" or "corrupt") and the number of bytes read
+	key, stored, codec, expected, offset, size = item
+	path = BACKUPROOT.join(stored, False)
+	sha256 = hashlib.sha256()
+	read = 0
+	try:
+		decompressor = None if codec is None else Decompressor(codec)
+		if offset is not None:
+			blocks = [path.readAt(offset, size)]
+		else:
+			blocks = path.blocks(CONFIG.get("bufferSize", 1024 * 1024))
+		for data in blocks:
+			read += len(data)
+			if bucket is not None:
+				bucket.consume(len(data))
+			sha256.update(data if decompressor is None else decompressor.decompress(data))
+		if decompressor is not None:
+			sha256.update(decompressor.flush())
+	except FileNotFoundError:
+		return "missing", read
+	except Exception:
+		if VERBOSE:
+			logger.info("could not read " + key + "\n" + traceback.format_exc())
+		return "corrupt", read
+	if (offset is not None and read != size) or sha256.hexdigest() != expected:
+		return "corrupt", read
+	return None, read
+
+
+def stillStored(item, references):
+	# a backup may have been merged or removed while verifying, only items a backup still refers to are broken
+	for created, file in references:
+		entry = CATALOG.getFile(file, created)
+		if entry is not None and entry["hash"] != "" and item in storedItems(created, file, entry):
+			return True
+	return False
+
+
+def verify(sample=None):
+	items = {}
+	references = {}
+	for file, entry, created in CATALOG.storedFiles():
+		for item in storedItems(created, file, entry):
+			items[item[0]] = item
+			references.setdefault(item[0], []).append((created, file))
+	keys = sorted(items)
+	checkpointPath = scriptPath("CODIBackup_verify.json", "verifyCheckpoint")
+	checkpoint = {"last": None, "items": 0, "bytes": 0, "problems": {}}
+	if sample is not None:
+		keys = [key for key in keys if random.random() * 100 < sample]
+	elif checkpointPath.isfile():
+		checkpointFile = File(checkpointPath, "r")
+		checkpoint = checkpointFile.readJSON()
+		checkpointFile.close()
+		keys = keys[bisect_right(keys, checkpoint["last"]):]
+		logger.info("resuming verification after " + checkpoint["last"])
+
+	rate = CONFIG.get("verifyRate", 0)
+	bucket = TokenBucket(rate) if rate > 0 else None
+	workers = CONFIG.get("verifyWorkers", 2)
+	slots = BoundedSemaphore(workers * 4)
+	pending = deque()
+	saved = time.monotonic()
+
+	def work(item):
+		try:
+			return verifyItem(item, bucket)
+		finally:
+			slots.release()
+
+	def collect(wait):
+		# results are taken in key order, so the checkpoint holds the last key all keys before were verified up to
+		nonlocal saved
+		while len(pending) > 0 and (wait or pending[0][1].done()):
+			key, future = pending.popleft()
+			problem, read = future.result()
+			if problem is not None and stillStored(items[key], references[key]):
+				checkpoint["problems"][key] = problem
+				logger.error(key + " is " + problem)
+			checkpoint["last"] = key
+			checkpoint["items"] += 1
+			checkpoint["bytes"] += read
+		if sample is None and checkpoint["last"] is not None and time.monotonic() - saved >= 60:
+			saved = time.monotonic()
+			checkpointPath.writeAtomic(json.dumps(checkpoint).encode("utf-8"))
+			if VERBOSE:
+				logger.info("verified " + str(checkpoint["items"]) + " stored items, " + str(checkpoint["bytes"] // (1024 * 1024)) + " MiB")
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for key in keys:
+			slots.acquire()
+			pending.append((key, pool.submit(work, items[key])))
+			collect(False)
+		collect(True)
+	if sample is None and checkpointPath.exists():
+		checkpointPath.rm()
+
+	broken = {}
+	for key, problem in checkpoint["problems"].items():
+		for created, file in references.get(key, []):
+			broken.setdefault(created, []).append((file, problem))
+	for backup in BACKUPS:
+		problems = broken.get(backup["created"], [])
+		if len(problems) > 0:
+			logger.error("backup " + backup["created"] + ": " + str(sum(1 for file, problem in problems if problem == "missing")) + " missing, " +
+			             str(sum(1 for file, problem in problems if problem == "corrupt")) + " corrupt files")
+			if VERBOSE:
+				for file, problem in sorted(problems):
+					logger.info(backup["created"] + ": " + file + " is " + problem)
+	logger.info("verified " + str(checkpoint["items"]) + " stored items, " + str(checkpoint["bytes"] // (1024 * 1024)) + " MiB, " +
+	            str(len(broken)) + " backups with missing or corrupt files")
+	return len(broken) == 0
 
 
 def createBackup():
 	now = datetime.now()
 	nowStr = now.strftime("%Y%m%dT%H%M%S")
 	if len(BACKUPS) > 0:
-		if now <= datetime.strptime(
-		    BACKUPS[0]["created"],
-		    "%Y%m%dT%H%M%S"):  #do not create backups if newer backup exists (just happens when system time is changed)
+		if nowStr <= BACKUPS[0]["created"]:  #do not create backups if newer backup exists (just happens when system time is changed)
 			return
+	unfinished = unfinishedBackup()
+	if unfinished is not None:
+		nowStr = unfinished
 	backupPath = BACKUPROOT.join(nowStr, True)
 	backupPath.mkdir()
 	backupType = BackupType.Minute
 	if len(BACKUPS) == 0:
 		backupType = BackupType.Base
 	currentBackup = {"files": {}, "folders": {}, "created": nowStr, "edited": nowStr, "type": backupType}
+	if OBJECTSTORE:
+		currentBackup["layout"] = OBJECTS
 
+	changes, journalLines = readJournal()
 	try:
-		for src in CONFIG["folders"]:
-			isFolder = os.path.isdir(src)
-			backupFolder(Path(src, isFolder), currentBackup, backupPath)
+		lowerPriority(CONFIG.get("ioPriority"), CONFIG.get("nice", 0))
+	except (OSError, ValueError) as e:
+		logger.error("could not lower the priority: " + str(e))
+	THROTTLE.start()
+	pipeline = BackupPipeline(backupPath)
+	resumed = pipeline.resumed
+	currentBackup["files"].update(resumed)
+	if unfinished is not None:
+		removeTemporary(backupPath)
+		if VERBOSE:
+			logger.info("resuming backup " + nowStr + " with " + str(len(resumed)) + " stored files")
+	# the backup folder is resumable from now on
+	TARGET.barrier()
+	visited = set()
+	try:
+		if changes is None:
+			walkRoots(currentBackup, pipeline, visited)
+		else:
+			removed = backupChanges(changes, currentBackup, pipeline, visited)
+		pipeline.finish(currentBackup)
 	except IOError as e:
 		logger.error(traceback.format_exc())
-		backupPath.rm()
-		if VERBOSE:
-			logger.info("IOError: abort backup " + currentBackup["created"])
+		if pipeline.checkpoint.exists():
+			if VERBOSE:
+				logger.info("IOError: interrupt backup " + currentBackup["created"] + ", the next run resumes it")
+		else:
+			backupPath.rm()
+			if VERBOSE:
+				logger.info("IOError: abort backup " + currentBackup["created"])
 		return
+	finally:
+		pipeline.close()
+		metrics = THROTTLE.stop()
+		if VERBOSE:
+			logger.info("read %.1f MiB, wrote %.1f MiB in %.1f s, threads waited %.1f s for the io limits and %.1f s for io pressure" %
+			            (metrics["read"] / 1024 / 1024, metrics["written"] / 1024 / 1024, metrics["seconds"], metrics["limited"], metrics["backedOff"]))
+	# the state must not reference data that is not on the target yet
+	TARGET.barrier()
+	for file in resumed:
+		if file not in visited:
+			# gone since the crashed run stored it
+			del currentBackup["files"][file]
+			if not OBJECTSTORE and "pack" not in resumed[file] and backupPath.join(file, False).exists():
+				removeStored(backupPath, file)
 
-	folderStructure = {"files": {}, "folders": {}}
-	for backup in BACKUPS:
-		for file in backup["files"].keys():
-			if file not in folderStructure["files"].keys():
-				folderStructure["files"][file] = backup["files"][file]
-		for folder in backup["folders"].keys():
-			if folder not in folderStructure["folders"].keys():
-				folderStructure["folders"][folder] = backup["folders"][folder]
-	for file in folderStructure["files"].keys():
-		if folderStructure["files"][file]["hash"] != "":
-			if not Path(file, False).isfile():
-				currentBackup["files"][file] = {"hash": "", "edited": ""}
-	for folder in folderStructure["folders"].keys():
-		if not Path(folder, True).isdir():
-			currentBackup["folders"][folder] = False
+	if changes is None:
+		markUnvisited(visited, currentBackup)
+	else:
+		markRemoved(removed, currentBackup)
 
 	if len(currentBackup["files"]) > 0 or len(currentBackup["folders"]) > 0:
-		statePath = backupPath.join("CODIBackup_state.json", False)
-		stateFile = File(statePath, "w")
-		stateFile.writeJSON(currentBackup)
-		stateFile.close()
+		writeState(currentBackup)
+		with CATALOG:
+			CATALOG.insertBackup(currentBackup)
+		pipeline.checkpoint.remove()
 		currentBackup["state"] = "uptodate"
-		BACKUPS.insert(0, currentBackup)
+		BACKUPS.insert(0, CatalogBackup(CATALOG, currentBackup))
+		INDEX.addBackup(currentBackup)
 		if VERBOSE:
 			logger.info("created backup: " + currentBackup["created"])
 	else:
 		backupPath.rm()
 		if VERBOSE:
 			logger.info("empty backup: deleting " + currentBackup["created"])
+	if journalLines > 0:
+		JOURNAL.consume(journalLines)
+	backupCount = len(BACKUPS)
 
-	backupMinutes = CONFIG["minutes"]
-	for backup in BACKUPS:
-		backupType = backup["type"]
-		if backupType == BackupType.Minute:
-			created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-			if now > created + timedelta(minutes=backupMinutes * 1):
-				backup["type"] = BackupType.Hour
-				backup["state"] = "changed"
-		else:
-			break
-	for i in reversed(range(len(BACKUPS))):
-		backup = BACKUPS[i]
-		backupType = backup["type"]
-		if backupType == BackupType.Hour:
-			while True:
-				if i > 0:
-					b = BACKUPS[i - 1]
-					if b["type"] == backupType:
-						created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-						edited = datetime.strptime(b["edited"], "%Y%m%dT%H%M%S")
-						if edited < created + timedelta(minutes=59):
-							mergeInto(b, backup)
-							del BACKUPS[i - 1]
-							i -= 1
-						else:
-							break
-					else:
-						break
-				else:
-					break
-		elif backupType == BackupType.Minute:
-			break
+	applyRetention(now)
 
-	backupHours = CONFIG["hours"]
 	for backup in BACKUPS:
-		backupType = backup["type"]
-		if backupType == BackupType.Hour:
-			created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-			if now > created + timedelta(hours=backupHours * 1) + timedelta(minutes=backupMinutes * 1):
-				backup["type"] = BackupType.Day
-				backup["state"] = "changed"
-		else:
-			break
-	for i in reversed(range(len(BACKUPS))):
-		backup = BACKUPS[i]
-		backupType = backup["type"]
-		if backupType == BackupType.Day:
-			while True:
-				if i > 0:
-					b = BACKUPS[i - 1]
-					if b["type"] == backupType:
-						created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-						edited = datetime.strptime(b["edited"], "%Y%m%dT%H%M%S")
-						if edited < created + timedelta(hours=23, minutes=59):
-							mergeInto(b, backup)
-							del BACKUPS[i - 1]
-							i -= 1
-						else:
-							break
-					else:
-						break
-				else:
-					break
-		elif backupType == BackupType.Hour or backupType == BackupType.Minute:
-			break
+		if backup["state"] == "changed":
+			backup["state"] = "uptodate"
+			with CATALOG:
+				CATALOG.updateBackup(backup)
+			writeState(backup)
+			if VERBOSE:
+				logger.info("rewrite " + backup["created"] + "/" + STATEFILE + " with type=" + backup["type"])
+	if OBJECTSTORE and len(BACKUPS) < backupCount:
+		collectGarbage()
+	TARGET.barrier()
+	# the catalog holds the files of all backups, keeping them in memory between backups only costs memory
+	for backup in BACKUPS:
+		backup.unload()
+
+
+def removeTemporary(backupPath):
+	# files a crashed run was still writing, in its backup and in the object store
+	for folder, folders, files in os.walk(backupPath.path):
+		for name in files:
+			if name.startswith(".CODIBackup_") and name.endswith(".tmp"):
+				os.remove(os.path.join(folder, name))
+	objectsPath = BACKUPROOT.join(OBJECTS, True)
+	if objectsPath.isdir():
+		for f in objectsPath.listdir():
+			if f.basename().startswith(".CODIBackup_") and f.basename().endswith(".tmp"):
+				f.rm()
 
-	backupDays = CONFIG["days"]
+
+def unfinishedBackup():
+	# the newest backup folder a crashed run left behind with a checkpoint, None if there is nothing to resume
+	known = set(backup["created"] for backup in BACKUPS)
+	newest = BACKUPS[0]["created"] if len(BACKUPS) > 0 else ""
+	for f in sorted(BACKUPROOT.listdir(), key=lambda p: p.path, reverse=True):
+		created = f.basename().rstrip(os.sep)
+		if f.isdir() and isBackupName(created) and created not in known and created > newest and Checkpoint(f).exists():
+			return created
+	return None
+
+
+def promotionAges():
+	# age after which a backup of a type is promoted to the next type
+	ages = {}
+	age = timedelta(minutes=CONFIG["minutes"])
+	ages[BackupType.Minute] = age
+	age += timedelta(hours=CONFIG["hours"])
+	ages[BackupType.Hour] = age
+	age += timedelta(days=CONFIG["days"])
+	ages[BackupType.Day] = age
+	age += timedelta(days=CONFIG["weeks"] * 7)
+	ages[BackupType.Week] = age
+	age += timedelta(days=CONFIG["months"] * 28)
+	ages[BackupType.Month] = age
+	age += timedelta(days=CONFIG["years"] * 12 * 28)
+	ages[BackupType.Year] = age
+	return ages
+
+
+def planRetention(now):
+	# simulates promotion and merging of all types on the metadata only, returns the surviving backups with the backups merged into them
+	ages = promotionAges()
+	plan = []
 	for backup in BACKUPS:
-		backupType = backup["type"]
-		if backupType == BackupType.Day:
-			created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-			if now > created + timedelta(days=backupDays * 1) + timedelta(hours=backupHours * 1) + timedelta(minutes=backupMinutes * 1):
-				backup["type"] = BackupType.Week
-				backup["state"] = "changed"
-		else:
+		plan.append({
+		    "backup": backup,
+		    "created": datetime.strptime(backup["created"], TIMEFORMAT),
+		    "edited": datetime.strptime(backup["edited"], TIMEFORMAT),
+		    "type": backup["type"],
+		    "updates": []
+		})
+	for i in range(len(TIERS) - 1):
+		backupType = TIERS[i]
+		nextType = TIERS[i + 1]
+		for record in plan:
+			if record["type"] == backupType and now > record["created"] + ages[backupType]:
+				record["type"] = nextType
+		window = MERGEWINDOWS[nextType]
+		merged = []
+		base = None
+		for record in reversed(plan):
+			if record["type"] != nextType:
+				base = None
+			elif base is not None and (window is None or record["edited"] < base["created"] + window):
+				base["updates"].append(record["backup"])
+				base["updates"].extend(record["updates"])
+				base["edited"] = record["edited"]
+				continue
+			else:
+				base = record
+			merged.append(record)
+		plan = list(reversed(merged))
+	return plan
+
+
+def applyRetention(now):
+	plan = planRetention(now)
+	for record in plan:
+		backup = record["backup"]
+		if record["type"] != backup["type"]:
+			backup["type"] = record["type"]
+			backup["state"] = "changed"
+		if len(record["updates"]) > 0:
+			mergeGroup(backup, record["updates"])
+	BACKUPS[:] = [record["backup"] for record in plan]
+
+
+def removeStored(basePath, file):
+	filePath = basePath.join(file, False)  #TODO os
+	filePath.rm()
+	parent = filePath.parent()
+	while True:
+		if parent.path == basePath.path:
 			break
-	for i in reversed(range(len(BACKUPS))):
-		backup = BACKUPS[i]
-		backupType = backup["type"]
-		if backupType == BackupType.Week:
-			while True:
-				if i > 0:
-					b = BACKUPS[i - 1]
-					if b["type"] == backupType:
-						created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-						edited = datetime.strptime(b["edited"], "%Y%m%dT%H%M%S")
-						if edited < created + timedelta(days=6, hours=23, minutes=59):
-							mergeInto(b, backup)
-							del BACKUPS[i - 1]
-							i -= 1
-						else:
-							break
-					else:
-						break
-				else:
-					break
-		elif backupType == BackupType.Day or backupType == BackupType.Hour or backupType == BackupType.Minute:
+		if len(parent.listdir()) == 0:
+			parent.rm()
+		else:
 			break
+		parent = parent.parent()
 
-	backupWeeks = CONFIG["weeks"]
-	for backup in BACKUPS:
-		backupType = backup["type"]
-		if backupType == BackupType.Week:
-			created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-			if now > created + timedelta(days=backupDays * 1 + backupWeeks * 7) + timedelta(hours=backupHours *
-			                                                                                1) + timedelta(minutes=backupMinutes * 1):
-				backup["type"] = BackupType.Month
-				backup["state"] = "changed"
+
+def mergeGroup(base, updates):
+	# merges updates (oldest first) into base at once, only the newest version of every path is kept and moved
+	if VERBOSE:
+		logger.info("merging " + ", ".join(update["created"] for update in updates) + " into " + base["created"])
+	dropTombstones = base["type"] == BackupType.Base
+	files = {}
+	folders = {}
+	for update in updates:
+		for file, entry in update["files"].items():
+			files[file] = (entry, update)
+		for folder, exists in update["folders"].items():
+			folders[folder] = exists
+	basePath = BACKUPROOT.join(base["created"], True)
+	packs = None
+	if not OBJECTSTORE:
+		packs = PackWriter(basePath.join(PACKS, True), CONFIG.get("packSize", 64 * 1024 * 1024))
+	# moved after all removals, so removing empty folders cannot race with a move into them
+	moves = []
+	for file, (entry, update) in files.items():
+		stored = base["files"].get(file)
+		storedLoose = stored is not None and stored["hash"] != "" and "pack" not in stored and not OBJECTSTORE
+		if entry["hash"] == "":
+			if storedLoose:
+				removeStored(basePath, file)
+				logger.info("remove " + file + " from " + base["created"])
+			if dropTombstones:
+				base["files"].pop(file, None)
+			else:
+				base["files"][file] = entry
 		else:
-			break
-	for i in reversed(range(len(BACKUPS))):
-		backup = BACKUPS[i]
-		backupType = backup["type"]
-		if backupType == BackupType.Month:
-			while True:
-				if i > 0:
-					b = BACKUPS[i - 1]
-					if b["type"] == backupType:
-						created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-						edited = datetime.strptime(b["edited"], "%Y%m%dT%H%M%S")
-						if edited < created + timedelta(days=27, hours=23, minutes=59):
-							mergeInto(b, backup)
-							del BACKUPS[i - 1]
-							i -= 1
-						else:
-							break
-					else:
-						break
+			if not OBJECTSTORE:
+				if "pack" in entry:
+					if storedLoose:
+						removeStored(basePath, file)
+					entry = repack(update["created"], file, entry, packs)
 				else:
-					break
-		elif backupType == BackupType.Week or backupType == BackupType.Day or backupType == BackupType.Hour or backupType == BackupType.Minute:
-			break
+					srcPath = BACKUPROOT.join(update["created"], True).join(file, False)  #TODO os
+					moves.append((srcPath, basePath.join(file, False)))
+			base["files"][file] = entry
+	for srcPath, dstPath in moves:
+		TARGET.submit(srcPath.mv, dstPath)
+	relocated = []
+	if packs is not None:
+		relocated = compactPacks(base, packs)
+		packs.close()
+	TARGET.barrier()
+	for folder, exists in folders.items():
+		if dropTombstones and not exists:
+			base["folders"].pop(folder, None)
+		else:
+			base["folders"][folder] = exists
+	base["edited"] = updates[-1]["edited"]
+	base["state"] = "changed"
+	for update in updates:
+		INDEX.merge(update, base, dropTombstones)
+	for file in relocated:
+		indexed = INDEX.getFile(file)
+		if indexed is not None and indexed["backup"] == base["created"]:
+			INDEX.addFile(file, base["files"][file], base["created"])
+	with CATALOG:
+		CATALOG.mergeGroup(base, updates, relocated)
+	for update in updates:
+		BACKUPROOT.join(update["created"], True).rm()
+
+
+def repack(created, file, entry, packs):
+	# copies the packed data of entry from backup created into packs
+	data = BACKUPROOT.join(storedName(created, file, entry), False).readAt(entry["packOffset"], entry["storedSize"])
+	pack, packOffset = packs.append(data)
+	return dict(entry, pack=pack, packOffset=packOffset)
+
+
+def compactPacks(backup, packs):
+	# rewrites the packs of backup that are mostly superseded into packs, returns the files that moved
+	live = {}
+	for file, entry in backup["files"].items():
+		if "pack" in entry and entry["pack"] not in packs.written:
+			live.setdefault(entry["pack"], []).append(file)
+	relocated = []
+	for f in packs.folder.listdir():
+		name = f.basename()
+		if name in packs.written:
+			continue
+		files = live.get(name, [])
+		if sum(backup["files"][file]["storedSize"] for file in files) * 2 >= f.getsize():
+			continue
+		for file in files:
+			backup["files"][file] = repack(backup["created"], file, backup["files"][file], packs)
+			relocated.append(file)
+		if VERBOSE:
+			logger.info("repacked " + str(len(files)) + " files of " + backup["created"] + "/" + PACKS + "/" + name)
+		f.rm()
+	return relocated
+
+
+def writeState(backup, force=False):
+	if not force and not CONFIG.get("stateFiles", True):
+		return
+	statePath = BACKUPROOT.join(backup["created"], True).join(STATEFILE, False)
+	backup["files"]  # backups read from the catalog load their files lazily
+	state = json.dumps({key: value for key, value in backup.items() if key != "state"}, indent=4)
+	statePath.writeAtomic(state.encode("utf-8"))
+
+
+def readState(created):
+	statePath = BACKUPROOT.join(created, True).join(STATEFILE, False)
+	stateFile = File(statePath, "r")
+	backup = stateFile.readJSON()
+	stateFile.close()
+	return backup
+
+
+def outdatedCatalog(backupNames):
+	# whether syncCatalog would import or remove a backup
+	known = set(backup["created"] for backup in CATALOG.backups())
+	if len(known - set(backupNames)) > 0:
+		return True
+	return any(created not in known and BACKUPROOT.join(created, True).join(STATEFILE, False).isfile() for created in backupNames)
 
-	backupMonths = CONFIG["months"]
+
+def syncCatalog(backupNames, reimport=False):
+	known = set(backup["created"] for backup in CATALOG.backups())
+	with CATALOG:
+		for created in sorted(known - set(backupNames)):
+			CATALOG.removeBackup(created)
+			if VERBOSE:
+				logger.info("remove vanished backup " + created + " from the catalog")
+		for created in sorted(backupNames):
+			if created in known and not reimport:
+				continue
+			if not BACKUPROOT.join(created, True).join(STATEFILE, False).isfile():
+				if Checkpoint(BACKUPROOT.join(created, True)).exists():
+					# an unfinished backup the next run resumes
+					continue
+				logger.warning("backup " + created + " has no " + STATEFILE + ", skipping it")
+				continue
+			CATALOG.insertBackup(readState(created))
+			if VERBOSE:
+				logger.info("import " + created + "/" + STATEFILE + " into the catalog")
+
+
+def exportState():
 	for backup in BACKUPS:
-		backupType = backup["type"]
-		if backupType == BackupType.Month:
-			created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-			if now > created + timedelta(days=backupDays * 1 + backupWeeks * 7 +
-			                             backupMonths * 28) + timedelta(hours=backupHours * 1) + timedelta(minutes=backupMinutes * 1):
-				backup["type"] = BackupType.Year
-				backup["state"] = "changed"
-		else:
-			break
-	for i in reversed(range(len(BACKUPS))):
-		backup = BACKUPS[i]
-		backupType = backup["type"]
-		if backupType == BackupType.Year:
-			while True:
-				if i > 0:
-					b = BACKUPS[i - 1]
-					if b["type"] == backupType:
-						created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-						edited = datetime.strptime(b["edited"], "%Y%m%dT%H%M%S")
-						if edited < created + timedelta(days=28 * 12 - 1, hours=23, minutes=59):
-							mergeInto(b, backup)
-							del BACKUPS[i - 1]
-							i -= 1
-						else:
-							break
-					else:
-						break
-				else:
-					break
-		elif backupType == BackupType.Month or backupType == BackupType.Week or backupType == BackupType.Day or backupType == BackupType.Hour or backupType == BackupType.Minute:
+		writeState(backup, True)
+		backup.unload()
+		if VERBOSE:
+			logger.info("export " + backup["created"] + "/" + STATEFILE)
+
+
+def collectGarbage():
+	referenced = CATALOG.objectNames()
+	objectsPath = BACKUPROOT.join(OBJECTS, True)
+	for folder in objectsPath.listdir():
+		prefix = folder.basename().rstrip(os.sep)
+		for f in folder.listdir():
+			if prefix + f.basename() not in referenced:
+				f.rm()
+				if VERBOSE:
+					logger.info("remove unreferenced object " + prefix + f.basename())
+		if len(folder.listdir()) == 0:
+			folder.rm()
+
+
+def migrateToObjects(backup):
+	if VERBOSE:
+		logger.info("migrating " + backup["created"] + " into the object store")
+	backupPath = BACKUPROOT.join(backup["created"], True)
+	for file, entry in backup["files"].items():
+		if "pack" in entry:
+			dstPath = objectPath(objectName(entry["hash"], entry.get("codec")))
+			if not dstPath.exists():
+				packPath = BACKUPROOT.join(storedName(backup["created"], file, entry), False)
+				dstPath.writeAtomic(packPath.readAt(entry["packOffset"], entry["storedSize"]), BACKUPROOT.join(OBJECTS, True))
+			del entry["pack"]
+			del entry["packOffset"]
+		elif entry["hash"] != "":
+			srcPath = backupPath.join(file, False)
+			dstPath = objectPath(objectName(entry["hash"], entry.get("codec")))
+			if not srcPath.isfile():
+				if not dstPath.exists():
+					logger.error("missing " + srcPath.path)
+				continue
+			if dstPath.exists():
+				srcPath.rm()
+			else:
+				srcPath.mv(dstPath)
+	backup["layout"] = OBJECTS
+	with CATALOG:
+		CATALOG.insertBackup(backup)
+	LEGACY.discard(backup["created"])
+	writeState(backup)
+	statePath = backupPath.join(STATEFILE, False)
+	for f in backupPath.listdir():
+		if f.path != statePath.path:
+			f.rm()
+
+
+def readJournal():
+	# returns the changed paths recorded since the last backup, None if the whole tree has to be walked
+	if JOURNAL is None:
+		return None, 0
+	journal = JOURNAL.read()
+	if journal is None:
+		return None, 0
+	since, overflowed, paths, lines = journal
+	reason = None
+	if len(BACKUPS) == 0:
+		reason = "no previous backup"
+	elif overflowed:
+		reason = "journal overflowed"
+	elif since is None or since >= BACKUPS[0]["created"]:
+		reason = "journal started after the last backup"
+	elif not JOURNAL.isWatched():
+		reason = "watcher is not running"
+	if reason is not None:
+		if VERBOSE:
+			logger.info("walking all folders: " + reason)
+		return None, lines
+	if VERBOSE:
+		logger.info("backing up " + str(len(paths)) + " changed paths from the journal")
+	return paths, lines
+
+
+def inRoots(path):
+	for root in CONFIG["folders"]:
+		root = Path(root, False).path
+		if path == root or path.startswith(root + os.sep):
+			return root
+	return None
+
+
+def isIgnored(path):
+	# the walker never descends into ignored folders, so every folder up to the root counts
+	root = inRoots(path)
+	current = Path(path, False)
+	while current is not None:
+		if IGNORE.match(current.path):
+			return True
+		if root is None or current.path.rstrip(os.sep) == root:
 			break
+		current = current.parent()
+	return False
 
-	backupYears = CONFIG["years"]
-	for backup in BACKUPS:
-		backupType = backup["type"]
-		if backupType == BackupType.Year:
-			created = datetime.strptime(backup["created"], "%Y%m%dT%H%M%S")
-			if now > created + timedelta(days=backupDays * 1 + backupWeeks * 7 + backupMonths * 28 +
-			                             backupYears * 12 * 28) + timedelta(hours=backupHours * 1) + timedelta(minutes=backupMinutes * 1):
-				backup["type"] = BackupType.Base
-				backup["state"] = "changed"
+
+def walkRoots(currentBackup, pipeline, visited):
+	# roots on different devices are walked at the same time, each device with its own hash and copy workers;
+	# every root collects into a backup of its own and they are merged in the order of the config, like a sequential walk
+	roots = []
+	devices = {}
+	for src in CONFIG["folders"]:
+		entry = Path(src, False).entry()
+		if entry is not None:
+			devices.setdefault(os.stat(entry.path).st_dev, []).append(len(roots))
+			roots.append(entry)
+	if len(devices) <= 1:
+		for root in roots:
+			backupFolder(root, currentBackup, pipeline, visited)
+		return
+	limits = {}
+	for folder, workers in CONFIG.get("deviceWorkers", {}).items():
+		if os.path.exists(folder):
+			limits[os.stat(folder).st_dev] = workers
+	lanes = [None] * len(roots)
+	results = [{"created": currentBackup["created"], "files": {}, "folders": {}} for root in roots]
+	pools = []
+	for device, indices in devices.items():
+		hashWorkers = limits.get(device, CONFIG.get("hashWorkers", 4))
+		copyWorkers = limits.get(device, CONFIG.get("copyWorkers", 2))
+		hashPool = ThreadPoolExecutor(max_workers=hashWorkers)
+		copyPool = ThreadPoolExecutor(max_workers=copyWorkers)
+		pools += [hashPool, copyPool]
+		hashSlots = BoundedSemaphore(hashWorkers * 4)
+		copySlots = BoundedSemaphore(copyWorkers * 4)
+		for i in indices:
+			lanes[i] = pipeline.fork(hashPool, hashSlots, copyPool, copySlots)
+
+	def walk(indices):
+		for i in indices:
+			backupFolder(roots[i], results[i], lanes[i], visited)
+			lanes[i].finish(results[i])
+
+	try:
+		with ThreadPoolExecutor(max_workers=len(devices)) as walkers:
+			for future in [walkers.submit(walk, indices) for indices in devices.values()]:
+				future.result()
+	finally:
+		for pool in pools:
+			pool.shutdown(wait=True, cancel_futures=True)
+	for result in results:
+		currentBackup["files"].update(result["files"])
+		currentBackup["folders"].update(result["folders"])
+
+
+def backupChanges(paths, currentBackup, pipeline, visited):
+	walked = []
+	removed = []
+	for path in sorted(paths):
+		if inRoots(path) is None or isIgnored(path):
+			continue
+		if (path + os.sep).startswith(tuple(walked)):
+			continue
+		entry = Path(path, False).entry()
+		if entry is None:
+			removed.append(path)
+			continue
+		if entry.isFolder:
+			walked.append(entry.path)
+		backupFolder(entry, currentBackup, pipeline, visited)
+	return removed
+
+
+def markUnvisited(visited, currentBackup):
+	# everything live below a root the walk did not see is gone, unless it is ignored now
+	roots = tuple(Path(root, False).path + os.sep for root in CONFIG["folders"])
+	for root in CONFIG["folders"]:
+		for file in INDEX.liveFiles(Path(root, False).path):
+			if file not in visited and (file + os.sep).startswith(roots) and not isIgnored(file):
+				currentBackup["files"][file] = {"hash": "", "edited": ""}
+		for folder in INDEX.liveFolders(Path(root, False).path):
+			if folder not in visited and folder.startswith(roots) and not isIgnored(folder):
+				currentBackup["folders"][folder] = False
+
+
+def markRemoved(removed, currentBackup):
+	removedFolders = []
+	for path in removed:
+		indexed = INDEX.getFile(path)
+		if indexed is not None and indexed["hash"] != "":
+			currentBackup["files"][path] = {"hash": "", "edited": ""}
+		indexed = INDEX.getFolder(path + os.sep)
+		if indexed is not None and indexed["exists"]:
+			removedFolders.append(path + os.sep)
+	if len(removedFolders) == 0:
+		return
+	for removedFolder in removedFolders:
+		for file in INDEX.liveFiles(removedFolder):
+			currentBackup["files"][file] = {"hash": "", "edited": ""}
+		for folder in INDEX.liveFolders(removedFolder):
+			currentBackup["folders"][folder] = False
+
+
+def watch():
+	if not JOURNAL.acquireWatch():
+		logger.error("another watcher is already running")
+		return
+	inotify = Inotify()
+	watches = {}
+
+	def addTree(folder):
+		if isIgnored(folder):
+			return
+		try:
+			watches[inotify.addWatch(folder)] = folder
+			for f in Path(folder, True).scandir():
+				if f.isFolder:
+					addTree(f.path)
+		except FileNotFoundError:
+			pass
+		except OSError:
+			logger.error(traceback.format_exc())
+			JOURNAL.overflow()
+
+	for src in CONFIG["folders"]:
+		src = Path(src, False)
+		if src.isdir():
+			addTree(src.path + os.sep)
 		else:
-			break
-	for i in reversed(range(len(BACKUPS))):
-		backup = BACKUPS[i]
-		backupType = backup["type"]
-		if backupType == BackupType.Base:
-			while True:
-				if i > 0:
-					b = BACKUPS[i - 1]
-					if b["type"] == backupType:
-						mergeInto(b, backup)
-						del BACKUPS[i - 1]
-						i -= 1
-					else:
-						break
-				else:
-					break
-		elif backupType == BackupType.Year or backupType == BackupType.Month or backupType == BackupType.Week or backupType == BackupType.Day or backupType == BackupType.Hour or backupType == BackupType.Minute:
-			break
+			watches[inotify.addWatch(src.parent().path, IN_CHANGES | IN_ONLYDIR)] = src.parent().path
+	JOURNAL.start(datetime.now().strftime("%Y%m%dT%H%M%S"))
+	if VERBOSE:
+		logger.info("watching " + str(len(watches)) + " folders")
+	dirty = set()
+	flushed = time.monotonic()
+	while True:
+		for wd, mask, cookie, name in inotify.read(1):
+			if mask & IN_Q_OVERFLOW:
+				logger.warning("inotify queue overflowed")
+				JOURNAL.overflow()
+				continue
+			if mask & IN_IGNORED:
+				watches.pop(wd, None)
+				continue
+			folder = watches.get(wd)
+			if folder is None:
+				continue
+			path = os.path.join(folder, name).rstrip(os.sep)
+			if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+				addTree(path + os.sep)
+			if inRoots(path) is not None and not isIgnored(path):
+				dirty.add(path)
+		if len(dirty) > 0 and time.monotonic() - flushed >= 1:
+			JOURNAL.append(sorted(dirty))
+			dirty.clear()
+			flushed = time.monotonic()
+
+
+def scriptPath(name, key):
+	if CONFIG.get(key) is not None:
+		return Path(CONFIG[key], False)
+	return Path(os.path.abspath(__file__), False).parent().join(name, False)
+
+
+def loadConfig(configPath):
+	global CONFIG, BACKUPROOT, JOURNAL, IGNORE
+	f = File(configPath, "r")
+	CONFIG = f.readJSON()
+	f.close()
+	IGNORE = IgnoreMatcher(CONFIG["ignore"])
+	TARGET.configure(CONFIG.get("sync", True), CONFIG.get("targetWorkers", 4))
+	THROTTLE.configure(CONFIG.get("readRate", 0), CONFIG.get("writeRate", 0), CONFIG.get("iops", 0), CONFIG.get("ioPressure", 0))
 
+	BACKUPROOT = Path(CONFIG["backupRoot"], True)
+	if not BACKUPROOT.isdir():
+		BACKUPROOT.mkdir()
+	JOURNAL = Journal(scriptPath("CODIBackup_journal.txt", "journal"))
+
+
+def loadBackups(reimport=False, locked=False):
+	# only a caller holding the backup lock may change the catalog and the stored files, the others read them as they are
+	global CATALOG, OBJECTSTORE, LEGACY
+	catalogPath = BACKUPROOT.join("CODIBackup_catalog.sqlite", False)
+	if CONFIG.get("catalog") is not None:
+		catalogPath = Path(CONFIG["catalog"], False)
+	CATALOG = Catalog(catalogPath, locked)
+
+	backupTimes = []
+	for f in BACKUPROOT.listdir():
+		if f.isdir() and isBackupName(f.basename()):  #TODO exclude softlink folders
+			backupTimes.append(f.basename().rstrip(os.sep))
+	if locked:
+		syncCatalog(backupTimes, reimport)
+	elif outdatedCatalog(backupTimes):
+		# the state files are read into a copy of the catalog for this run only
+		logger.warning("the catalog does not match the backup folders, reading their " + STATEFILE +
+		               " for this run; run --import-state or a backup to update it")
+		CATALOG.detach()
+		syncCatalog(backupTimes)
+	del BACKUPS[:]
+	for backup in CATALOG.backups():
+		backup["state"] = "uptodate"
+		BACKUPS.append(backup)
+
+	OBJECTSTORE = CONFIG.get("objectStore", False)
 	for backup in BACKUPS:
-		if backup["state"] == "changed":
-			del backup["state"]
-			backupStatePath = BACKUPROOT.join(backup["created"], True).join("CODIBackup_state.json", False)
-			backupStatePath.rm()
-			backupStateFile = File(backupStatePath, "w")
-			backupStateFile.writeJSON(backup)
-			backupStateFile.close()
-			if VERBOSE:
-				logger.info("rewrite " + backup["created"] + "/CODIBackup_state.json with type=" + backup["type"])
+		if backup.get("layout") == OBJECTS:
+			OBJECTSTORE = True
+	LEGACY = set()
+	if OBJECTSTORE:
+		LEGACY = set(backup["created"] for backup in BACKUPS if backup.get("layout") != OBJECTS)
+	if OBJECTSTORE and locked:
+		for backup in BACKUPS:
+			if backup.get("layout") != OBJECTS:
+				migrateToObjects(backup)
 
 
-def mergeInto(update, base):
-	if VERBOSE:
-		logger.info("merging " + update["created"] + " into " + base["created"])
-	base["edited"] = update["edited"]
-	base["state"] = "changed"
-	for file in update["files"]:
-		if update["files"][file]["hash"] == "":
-			fileExists = False
-			if file in base["files"].keys():
-				if base["files"][file]["hash"] != "":
-					fileExists = True
-			if base["type"] == BackupType.Base:
-				#if file in base["files"].keys():
-				del base["files"][file]
-				base["state"] = "changed"
+def loadIndex():
+	INDEX.clear()
+	for file, entry, created in CATALOG.latestFiles():
+		INDEX.addFile(file, entry, created)
+	for folder, exists, created in CATALOG.latestFolders():
+		INDEX.addFolder(folder, bool(exists), created)
+
+
+def acquireLock():
+	global LOCKFD
+	fd = os.open(scriptPath("CODIBackup.lock", "lock").path, os.O_RDWR | os.O_CREAT, 0o600)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except BlockingIOError:
+		os.close(fd)
+		return False
+	LOCKFD = fd
+	return True
+
+
+class DaemonHandler(StreamRequestHandler):
+	def handle(self):
+		try:
+			self.respond()
+		except (BrokenPipeError, ConnectionResetError):
+			# the client stopped reading, like a peek piped into head
+			pass
+
+	def respond(self):
+		# every request reads the last committed backups through its own connection in one read transaction,
+		# so it neither waits for a running backup nor sees half of it, and its answer is streamed from there
+		catalog = None
+		items = None
+		try:
+			request = json.loads(self.rfile.readline())
+			catalog = Catalog(CATALOG.path, False)
+			catalog.snapshot()
+			if request["command"] == "peek":
+				items = peek(request["timestamp"], request.get("prefix"), catalog)
+			elif request["command"] == "diff":
+				items = diff(request["older"], request["newer"], request.get("prefix"), catalog)
+			elif request["command"] == "snapshot":
+				items = snapshotItems(request["timestamp"], request.get("prefix"), catalog)
+			elif request["command"] == "status":
+				response = {"backups": [{"created": backup["created"], "edited": backup["edited"], "type": backup["type"]} for backup in catalog.backups()]}
 			else:
-				base["files"][file] = update["files"][file]
-				base["state"] = "changed"
-			if fileExists:
-				basePath = BACKUPROOT.join(base["created"], True)
-				filePath = basePath.join(file, False)  #TODO os
-				filePath.rm()
-				parent = filePath.parent()
-				while True:
-					if parent.path == basePath.path:
-						break
-					if len(parent.listdir()) == 0:
-						parent.rm()
-					else:
-						break
-					parent = parent.parent()
-				logger.info("remove " + file + " from " + base["created"])
-		else:
-			# if file in base["files"].keys():
-			# 	if base["files"][file]["hash"] != "":
-			# 		pass
-			base["files"][file] = update["files"][file]
-			srcPath = BACKUPROOT.join(update["created"], True).join(file, False)  #TODO os
-			dstPath = BACKUPROOT.join(base["created"], True).join(file, False)  #TODO os
-			srcPath.mv(dstPath)
-			base["state"] = "changed"
-	for folder in update["folders"].keys():
-		exists = update["folders"][folder]
-		if base["type"] == BackupType.Base and not exists:
-			if folder in base["folders"].keys():
-				del base["folders"][folder]
-				base["state"] = "changed"
-		else:
-			base["folders"][folder] = exists
-	BACKUPROOT.join(update["created"], True).rm()
+				response = {"error": "unknown command " + str(request["command"])}
+			if items is None:
+				self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+				return
+			# streamed as one json line per stored name, change or snapshot entry, terminated by null
+			self.wfile.write(b'{"stream": true}\n')
+			for item in items:
+				self.wfile.write(json.dumps(item).encode("utf-8") + b"\n")
+			self.wfile.write(b"null\n")
+		except (BrokenPipeError, ConnectionResetError):
+			raise
+		except Exception as e:
+			logger.error(traceback.format_exc())
+			# after the stream started the error takes the place of the next item
+			self.wfile.write(json.dumps({"error": str(e)}).encode("utf-8") + b"\n")
+		finally:
+			if catalog is not None:
+				catalog.close()
+
 
+def queryDaemon(request):
+	# returns None if no daemon is listening or it does not answer in time, the caller then reads the catalog itself
+	socketPath = scriptPath("CODIBackup.sock", "socket")
+	if not socketPath.exists():
+		return None
+	timeout = CONFIG.get("daemonTimeout", 10)
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(timeout)
+	reader = client.makefile("rb")
+	try:
+		client.connect(socketPath.path)
+		client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+		response = json.loads(reader.readline())
+	except (ConnectionRefusedError, FileNotFoundError, socket.timeout) as e:
+		reader.close()
+		client.close()
+		if isinstance(e, socket.timeout):
+			logger.warning("the daemon did not answer within " + str(timeout) + " s, reading the catalog")
+		return None
+	if response.get("stream"):
+		# streamed responses keep the connection open until all items are read
+		response["items"] = streamItems(client, reader)
+		return response
+	reader.close()
+	client.close()
+	if "error" in response:
+		raise RuntimeError("daemon: " + response["error"])
+	return response
 
-def backupFolder(src, currentBackup, backupPath):
-	if src.isdir():
-		filename = src.basename()
-		for ignored in CONFIG["ignore"]:
-			if PurePath(src.path).match(ignored):
+
+def streamItems(client, reader):
+	try:
+		for line in reader:
+			item = json.loads(line)
+			if item is None:
 				return
-		for f in src.listdir():
-			backupFolder(f, currentBackup, backupPath)
+			if isinstance(item, dict):
+				raise RuntimeError("daemon: " + item["error"])
+			yield item
+		raise RuntimeError("daemon: connection closed")
+	except socket.timeout:
+		raise RuntimeError("daemon: stopped answering")
+	finally:
+		reader.close()
+		client.close()
+
+
+def snapshotState(items):
+	# the files and folders of a streamed snapshot
+	files = {}
+	folders = []
+	for path, entry in items:
+		if entry is None:
+			folders.append(path)
+		else:
+			files[path] = entry
+	return files, folders
+
+
+def daemon():
+	if not acquireLock():
+		logger.error("another backup is running")
+		return
+	loadBackups(locked=True)
+	CATALOG.shareReads()
+	loadIndex()
+	socketPath = scriptPath("CODIBackup.sock", "socket")
+	if socketPath.exists():
+		socketPath.rm()
+	server = ThreadingUnixStreamServer(socketPath.path, DaemonHandler)
+	server.daemon_threads = True
+	Thread(target=server.serve_forever, daemon=True).start()
+	interval = CONFIG.get("interval", 60) * 60
+	if VERBOSE:
+		logger.info("daemon listening on " + socketPath.path)
+	while True:
+		started = time.monotonic()
+		try:
+			createBackup()
+		except Exception:
+			logger.error(traceback.format_exc())
+			loadBackups(locked=True)
+			loadIndex()
+		time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+def isUnchanged(src, indexed):
+	if indexed is None or indexed["hash"] == "":
+		return False
+	if "mtime" in indexed:
+		return indexed["mtime"] == src.mtime and indexed.get("size") == src.size
+	# entries of older backups only know the mtime in seconds
+	return indexed["edited"] == src.getmtime().strftime("%Y%m%dT%H%M%S")
+
+
+def backupFolder(src, currentBackup, pipeline, visited=None):
+	# ignored folders are skipped before they are listed
+	if IGNORE.match(src.path):
+		return
+	if visited is not None:
+		visited.add(src.path)
+	if src.isFolder:
+		for f in sorted(src.scandir(), key=lambda p: p.path):
+			backupFolder(f, currentBackup, pipeline, visited)
 		while True:
 			folderExists = -1
-			for backup in BACKUPS:
-				if src.path in backup["folders"].keys():
-					if backup["folders"][src.path]:
-						folderExists = 1
-					else:
-						folderExists = 0
-					break
+			indexed = INDEX.getFolder(src.path)
+			if indexed is not None:
+				if indexed["exists"]:
+					folderExists = 1
+				else:
+					folderExists = 0
 			if folderExists == -1 or folderExists == 0:
 				currentBackup["folders"][src.path] = True
 			if src.isroot() or folderExists == 1:
 				break
 			src = src.parent()
-	elif src.isfile():
-		filename = src.basename()
-		for ignored in CONFIG["ignore"]:
-			if PurePath(src.path).match(ignored):
-				return
-		storedHash = ""
-		storedEdited = ""
-		for backup in BACKUPS:
-			if src.path in backup["files"].keys():
-				storedHash = backup["files"][src.path]["hash"]
-				storedEdited = backup["files"][src.path]["edited"]
-				break
-		if src.getmtime().strftime("%Y%m%dT%H%M%S") != storedEdited:
-			f = File(src, "rb")
-			sha256 = hashlib.sha256()
-			while True:
-				data = f.read(4096)
-				if not data:
-					break
-				sha256.update(data)
-			f.close()
-			calculatedHash = sha256.hexdigest()
-			if calculatedHash != storedHash:
-				currentBackup["files"][src.path] = {"hash": calculatedHash, "edited": src.getmtime().strftime("%Y%m%dT%H%M%S")}
-				src.cp(backupPath.join(src.path, False))
-				if VERBOSE:
-					logger.info("backing up " + src.path)
+	else:
+		# files a crashed run of this backup stored already count as stored
+		indexed = pipeline.resumed.get(src.path) or INDEX.getFile(src.path)
+		if not isUnchanged(src, indexed):
+			pipeline.submit(src, indexed)
+			pipeline.save(currentBackup)
 
 
 if __name__ == "__main__":
@@ -476,60 +1677,103 @@ if __name__ == "__main__":
 		parser.add_argument("-p", "--peek", help="lists all files from a backup")
 		parser.add_argument("-r", "--recover", help="recovers a specific state from the backups")
 		parser.add_argument("-a", "--all", action="store_true", help="sets flag to restore everything")
-		parser.add_argument("-s", "--selection", help="select file or folder to be recovered")
+		parser.add_argument("-s", "--selection", help="select file or folder to be recovered, peeked, diffed or exported")
+		parser.add_argument("-e", "--export", help="writes a specific state from the backups as tar to stdout or --output")
+		parser.add_argument("-o", "--output", help="file the export is written to")
+		parser.add_argument("--compress", choices=["gz", "bz2", "xz"], help="compresses the export, by default chosen by the suffix of --output")
+		parser.add_argument("--diff", nargs=2, metavar=("T1", "T2"), help="lists the files and folders added, deleted or modified between two times")
 		parser.add_argument("-c", "--config", help="specify a configfile")
+		parser.add_argument("-w", "--watch", action="store_true", help="records changed files so backups do not need to walk all folders")
+		parser.add_argument("-d", "--daemon", action="store_true", help="creates backups periodically and answers peek and recover requests")
+		parser.add_argument("--verify", action="store_true", help="re-hashes the stored files and reports missing or corrupt ones per backup")
+		parser.add_argument("--sample", type=float, help="verifies only a random share of the stored files, in percent")
+		parser.add_argument("--import-state", action="store_true", help="rebuilds the catalog from the state files of all backups")
+		parser.add_argument("--export-state", action="store_true", help="rewrites the state files of all backups from the catalog")
 		args = parser.parse_args()
 		valid = False
 		VERBOSE = args.verbose
 
 		configPath = Path(os.path.abspath(__file__), False).parent().join("config.json", False)
 		if args.config is not None:
-			configPath = Path(os.path.abspath(os.path.expanduser(args.configPath)), False)
-
-		f = File(configPath, "r")
-		CONFIG = f.readJSON()
-		f.close()
-
-		BACKUPROOT = Path(CONFIG["backupRoot"], True)
-		if not BACKUPROOT.isdir():
-			BACKUPROOT.mkdir()
-
-		backupTimes = []
-		for f in BACKUPROOT.listdir():
-			if f.isdir():  #TODO exclude softlink folders
-				backupTimes.append(f.basename())
-		backupTimes.sort(reverse=True)
-		for b in backupTimes:
-			# if VERBOSE:
-			# 	logger.debug("loading " + b.path)
-			statePath = BACKUPROOT.join(b, True).join("CODIBackup_state.json", False)
-			stateFile = File(statePath, "r")
-			ba = json.loads(stateFile.read())
-			stateFile.close()
-			ba["state"] = "uptodate"
-			# if VERBOSE:
-			# 	logger.debug(ba["type"])
-			BACKUPS.append(ba)
-		# logger.debug(BACKUPS)
+			configPath = Path(os.path.abspath(os.path.expanduser(args.config)), False)
+		loadConfig(configPath)
+
+		if args.watch:
+			watch()
+		if args.daemon:
+			daemon()
+		locked = args.backup or args.import_state or args.export_state
+		if locked and not acquireLock():
+			logger.error("another backup is running, skipping this one")
+			sys.exit(1)
+
+		if args.peek is not None or args.recover is not None or args.diff is not None:
+			if args.diff is not None:
+				changes = queryDaemon({"command": "diff", "older": args.diff[0], "newer": args.diff[1], "prefix": args.selection})
+				if changes is not None:
+					changes = changes["items"]
+				warm = changes
+			elif args.peek is not None:
+				names = queryDaemon({"command": "peek", "timestamp": args.peek, "prefix": args.selection})
+				if names is not None:
+					names = names["items"]
+				warm = names
+			else:
+				state = None
+				if args.all or args.selection is not None:
+					state = queryDaemon({"command": "snapshot", "timestamp": args.recover, "prefix": None if args.all else args.selection})
+				if state is not None:
+					state = snapshotState(state["items"])
+				warm = state
+			if warm is None:
+				loadBackups()
+		else:
+			loadBackups(args.import_state, locked)
+		if args.backup:
+			loadIndex()
 
 		if args.backup:
 			createBackup()
 			valid = True
+		elif args.import_state:
+			valid = True
+		elif args.export_state:
+			exportState()
+			valid = True
+		elif args.export is not None:
+			compression = args.compress
+			if compression is None and args.output is not None:
+				for suffix, codec in [(".gz", "gz"), (".tgz", "gz"), (".bz2", "bz2"), (".xz", "xz")]:
+					if args.output.endswith(suffix):
+						compression = codec
+			export(args.export, args.selection, args.output, compression)
+			valid = True
+		elif args.verify:
+			if not verify(args.sample):
+				sys.exit(1)
+			valid = True
+		elif args.diff is not None:
+			if changes is None:
+				changes = diff(args.diff[0], args.diff[1], args.selection)
+			for status, path, change in changes:
+				print(diffLine(status, path, change))
+			valid = True
 		else:
 			if args.peek is not None:
-				folderStructure = peek(args.peek)
-				for file in folderStructure["files"].keys():
-					print(folderStructure["files"][file])
+				if names is None:
+					names = peek(args.peek, args.selection)
+				for name in names:
+					print(name)
 				valid = True
 			elif args.recover is not None:
 				toBeRecovered = None
-				if args.all is not None:
-					recover(args.recover, toBeRecovered)
+				if args.all:
+					recover(args.recover, toBeRecovered, state)
 					valid = True
 				else:
 					if args.selection is not None:
 						toBeRecovered = args.selection
-						recover(args.recover, toBeRecovered)
+						recover(args.recover, toBeRecovered, state)
 						valid = True
 		if not valid:
 			parser.print_help()
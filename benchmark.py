@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import hashlib
+import random
+import tracemalloc
+from argparse import ArgumentParser
+from codi.index import PathIndex
+
+# memory of the newest state of a synthetic tree: the dicts used before against the compact PathIndex
+
+
+def tree(files):
+	random.seed(0)
+	names = ["__init__.py", "main.c", "README.md", "notes.txt", "photo.jpg", "song.flac", "data.json", "index.html"]
+	for i in range(files):
+		yield "/home/bla/projects/project" + str(i // 5000) + "/src/module" + str(i // 50) + "/" + str(i % 50) + random.choice(names)
+
+
+def entries(files, backups):
+	# the newest entry of every file and the backup it is in, like loadIndex reads them from the catalog
+	for i, path in enumerate(tree(files)):
+		created = "2024%02d%02dT%02d0000" % (1 + i % backups % 12, 1 + i % 28, i % 24)
+		entry = {"hash": hashlib.sha256(path.encode()).hexdigest(), "edited": created, "size": i * 7, "mtime": 1700000000000000000 + i}
+		yield path, entry, created
+
+
+def dictModel(files, backups):
+	index = {}
+	for path, entry, created in entries(files, backups):
+		indexed = dict(entry)
+		indexed["backup"] = created
+		index[path] = indexed
+	return index
+
+
+def compactModel(files, backups):
+	index = PathIndex()
+	for path, entry, created in entries(files, backups):
+		index.addFile(path, entry, created)
+	return index
+
+
+def measure(model, files, backups):
+	tracemalloc.start()
+	ret = model(files, backups)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	del ret
+	return size
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser()
+	parser.add_argument("-f", "--files", type=int, default=200000, help="number of files")
+	parser.add_argument("-b", "--backups", type=int, default=300, help="number of backups the files are spread over")
+	args = parser.parse_args()
+	old = measure(dictModel, args.files, args.backups)
+	new = measure(compactModel, args.files, args.backups)
+	print("dicts:     " + str(old // (1024 * 1024)) + " MiB, " + str(old // args.files) + " bytes per file")
+	print("PathIndex: " + str(new // (1024 * 1024)) + " MiB, " + str(new // args.files) + " bytes per file")
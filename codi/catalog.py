@@ -0,0 +1,299 @@
+import sqlite3
+from urllib.parse import quote
+
+# the folder containing a path, up to its last separator, so the entries of a folder are found by an index
+FILEPARENT = "rtrim(path, replace(path, '/', ''))"
+FOLDERPARENT = "rtrim(substr(path, 1, length(path) - 1), replace(substr(path, 1, length(path) - 1), '/', ''))"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+	created TEXT PRIMARY KEY,
+	edited TEXT NOT NULL,
+	type TEXT NOT NULL,
+	layout TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+	path TEXT NOT NULL,
+	backup TEXT NOT NULL,
+	hash TEXT NOT NULL,
+	edited TEXT NOT NULL,
+	size INTEGER,
+	mtime INTEGER,
+	chunks TEXT,
+	codec TEXT,
+	storedSize INTEGER,
+	pack TEXT,
+	packOffset INTEGER,
+	PRIMARY KEY (path, backup)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS filesBackup ON files (backup);
+CREATE TABLE IF NOT EXISTS folders (
+	path TEXT NOT NULL,
+	backup TEXT NOT NULL,
+	present INTEGER NOT NULL,
+	PRIMARY KEY (path, backup)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS foldersBackup ON folders (backup);
+CREATE INDEX IF NOT EXISTS filesParent ON files (""" + FILEPARENT + """, path, backup);
+CREATE INDEX IF NOT EXISTS foldersParent ON folders (""" + FOLDERPARENT + """, path, backup);
+"""
+# stored in user_version, a catalog without tables has version 0
+VERSION = 1
+ENTRYCOLUMNS = "hash, edited, size, mtime, chunks, codec, storedSize, pack, packOffset"
+FILECOLUMNS = "path, backup, " + ENTRYCOLUMNS
+
+
+class CatalogBackup(dict):
+	# state of a backup whose files and folders are only read from the catalog when accessed
+	def __init__(self, catalog, backup):
+		super().__init__(backup)
+		self.catalog = catalog
+
+	def __missing__(self, key):
+		if key != "files" and key != "folders":
+			raise KeyError(key)
+		files, folders = self.catalog.loadBackup(self["created"])
+		self["files"] = files
+		self["folders"] = folders
+		return self[key]
+
+	def load(self):
+		self["files"]
+		return self
+
+	def unload(self):
+		# drops the files and folders, they are read again when accessed
+		self.pop("files", None)
+		self.pop("folders", None)
+
+
+class Catalog():
+	# a catalog opened without writable never writes its file, so it also works on read-only media
+	def __init__(self, path, writable=True):
+		self.path = path
+		# callers serialise access, the daemon shares the connection between threads
+		if writable:
+			self.db = sqlite3.connect(path.path, check_same_thread=False)
+		elif path.exists():
+			self.db = connectReadOnly(path)
+		else:
+			self.db = sqlite3.connect(":memory:", check_same_thread=False)
+		if self.db.execute("PRAGMA user_version").fetchone()[0] == 0:
+			if not writable:
+				self.detach()
+			with self.db:
+				self.db.executescript(SCHEMA)
+				self.db.execute("PRAGMA user_version = " + str(VERSION))
+
+	def detach(self):
+		# continues on an in-memory copy which can be changed without touching the file
+		memory = sqlite3.connect(":memory:", check_same_thread=False)
+		self.db.backup(memory)
+		self.db.close()
+		self.db = memory
+
+	def shareReads(self):
+		# readers on other connections see the last commit instead of waiting for a writer, the mode stays with the file
+		self.db.execute("PRAGMA journal_mode=WAL")
+
+	def snapshot(self):
+		# all following reads see the catalog as it is at the first of them, until the connection is closed
+		self.db.execute("BEGIN")
+
+	def __enter__(self):
+		return self.db.__enter__()
+
+	def __exit__(self, excType, excValue, tb):
+		return self.db.__exit__(excType, excValue, tb)
+
+	def close(self):
+		return self.db.close()
+
+	def backups(self):
+		ret = []
+		for created, edited, backupType, layout in self.db.execute("SELECT created, edited, type, layout FROM backups ORDER BY created DESC"):
+			backup = {"created": created, "edited": edited, "type": backupType}
+			if layout is not None:
+				backup["layout"] = layout
+			ret.append(CatalogBackup(self, backup))
+		return ret
+
+	def backupAt(self, timestamp):
+		# created of the newest backup up to timestamp, None if there is none
+		return self.db.execute("SELECT max(created) FROM backups WHERE created <= ?", (timestamp, )).fetchone()[0]
+
+	def loadBackup(self, created):
+		files = {}
+		folders = {}
+		for row in self.db.execute("SELECT path, " + ENTRYCOLUMNS + " FROM files WHERE backup = ?", (created, )):
+			files[row[0]] = fileEntry(*row[1:])
+		for path, present in self.db.execute("SELECT path, present FROM folders WHERE backup = ?", (created, )):
+			folders[path] = bool(present)
+		return files, folders
+
+	def insertBackup(self, backup):
+		created = backup["created"]
+		self.db.execute("INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?)", (created, backup["edited"], backup["type"], backup.get("layout")))
+		self.db.execute("DELETE FROM files WHERE backup = ?", (created, ))
+		self.db.execute("DELETE FROM folders WHERE backup = ?", (created, ))
+		self.db.executemany("INSERT INTO files (" + FILECOLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+		                    (fileRow(path, created, entry) for path, entry in backup["files"].items()))
+		self.db.executemany("INSERT INTO folders VALUES (?, ?, ?)", ((path, created, int(present)) for path, present in backup["folders"].items()))
+
+	def updateBackup(self, backup):
+		self.db.execute("UPDATE backups SET edited = ?, type = ?, layout = ? WHERE created = ?",
+		                (backup["edited"], backup["type"], backup.get("layout"), backup["created"]))
+
+	def removeBackup(self, created):
+		self.db.execute("DELETE FROM backups WHERE created = ?", (created, ))
+		self.db.execute("DELETE FROM files WHERE backup = ?", (created, ))
+		self.db.execute("DELETE FROM folders WHERE backup = ?", (created, ))
+
+	def mergeGroup(self, base, updates, relocated=()):
+		# base already holds the merged state, only the paths touched by updates and the relocated paths of base change
+		created = base["created"]
+		baseFiles = base["files"]
+		baseFolders = base["folders"]
+		files = set()
+		folders = set()
+		for update in updates:
+			files.update(update["files"])
+			folders.update(update["folders"])
+			self.removeBackup(update["created"])
+		self.updateBackup(base)
+		self.db.executemany("DELETE FROM files WHERE path = ? AND backup = ?", ((path, created) for path in files if path not in baseFiles))
+		self.db.executemany("INSERT OR REPLACE INTO files (" + FILECOLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+		                    (fileRow(path, created, baseFiles[path]) for path in files if path in baseFiles))
+		self.db.executemany("INSERT OR REPLACE INTO files (" + FILECOLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+		                    (fileRow(path, created, baseFiles[path]) for path in relocated))
+		self.db.executemany("DELETE FROM folders WHERE path = ? AND backup = ?", ((path, created) for path in folders if path not in baseFolders))
+		self.db.executemany("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)",
+		                    ((path, created, int(baseFolders[path])) for path in folders if path in baseFolders))
+
+	def latestFiles(self, created=None, prefix=None):
+		# (path, entry, backup) of the newest state of every path in all backups up to created, tombstones included, ordered by path
+		where, params = latestFilter(created, prefix)
+		for row in self.db.execute("SELECT path, " + ENTRYCOLUMNS + ", max(backup) FROM files" + where + " GROUP BY path ORDER BY path", params):
+			yield row[0], fileEntry(*row[1:-1]), row[-1]
+
+	def latestFolders(self, created=None, prefix=None):
+		where, params = latestFilter(created, prefix)
+		return self.db.execute("SELECT path, present, max(backup) FROM folders" + where + " GROUP BY path ORDER BY path", params)
+
+	def latestFile(self, path, created=None):
+		# (entry, backup) of the newest state of path up to created, None if it was never backed up
+		where, params = latestFilter(created, None)
+		row = self.db.execute("SELECT " + ENTRYCOLUMNS + ", max(backup) FROM files" + (where + " AND" if where else " WHERE") + " path = ?",
+		                      params + [path]).fetchone()
+		if row[-1] is None:
+			return None
+		return fileEntry(*row[:-1]), row[-1]
+
+	def latestFolder(self, path, created=None):
+		# (present, backup) of the newest state of folder path up to created, None if it was never backed up
+		where, params = latestFilter(created, None)
+		row = self.db.execute("SELECT present, max(backup) FROM folders" + (where + " AND" if where else " WHERE") + " path = ?",
+		                      params + [path]).fetchone()
+		if row[-1] is None:
+			return None
+		return bool(row[0]), row[1]
+
+	def childFiles(self, folder, created=None):
+		# like latestFiles, but only for the files directly in folder
+		where, params = latestFilter(created, None)
+		for row in self.db.execute(
+		    "SELECT path, " + ENTRYCOLUMNS + ", max(backup) FROM files" + (where + " AND " if where else " WHERE ") + FILEPARENT +
+		    " = ? GROUP BY path ORDER BY path", params + [folder]):
+			yield row[0], fileEntry(*row[1:-1]), row[-1]
+
+	def childFolders(self, folder, created=None):
+		where, params = latestFilter(created, None)
+		return self.db.execute(
+		    "SELECT path, present, max(backup) FROM folders" + (where + " AND " if where else " WHERE ") + FOLDERPARENT +
+		    " = ? GROUP BY path ORDER BY path", params + [folder])
+
+	def changedFiles(self, older, newer, prefix=None):
+		# (path, entry, backup) of the newest state up to newer of every file a backup after older recorded, ordered by path;
+		# only the rows of those backups are read, even with a prefix
+		where, params = latestFilter(newer, prefix)
+		for row in self.db.execute("SELECT path, " + ENTRYCOLUMNS + ", max(backup) FROM files INDEXED BY filesBackup" + where + " AND backup > ? GROUP BY path ORDER BY path",
+		                           params + [older]):
+			yield row[0], fileEntry(*row[1:-1]), row[-1]
+
+	def changedFolders(self, older, newer, prefix=None):
+		where, params = latestFilter(newer, prefix)
+		return self.db.execute("SELECT path, present, max(backup) FROM folders INDEXED BY foldersBackup" + where + " AND backup > ? GROUP BY path ORDER BY path",
+		                       params + [older])
+
+	def getFile(self, path, created):
+		row = self.db.execute("SELECT " + ENTRYCOLUMNS + " FROM files WHERE path = ? AND backup = ?", (path, created)).fetchone()
+		if row is None:
+			return None
+		return fileEntry(*row)
+
+	def storedFiles(self):
+		# (path, entry, backup) of every file of every backup that is not a tombstone
+		for row in self.db.execute("SELECT path, " + ENTRYCOLUMNS + ", backup FROM files WHERE hash != ''"):
+			yield row[0], fileEntry(*row[1:-1]), row[-1]
+
+	def objectNames(self):
+		# every stored object, chunked files reference their chunks
+		ret = set(row[0] for row in self.db.execute("SELECT DISTINCT hash || coalesce('.' || codec, '') FROM files WHERE hash != '' AND chunks IS NULL"))
+		for row in self.db.execute("SELECT chunks FROM files WHERE chunks IS NOT NULL"):
+			ret.update(row[0].split())
+		return ret
+
+
+def connectReadOnly(path):
+	uri = "file:" + quote(path.path)
+	db = sqlite3.connect(uri + "?mode=ro", uri=True, check_same_thread=False)
+	try:
+		db.execute("PRAGMA user_version").fetchone()
+	except sqlite3.OperationalError:
+		# a catalog in WAL mode needs its shared memory file, which read-only media can not provide, but nobody writes it there either
+		db.close()
+		db = sqlite3.connect(uri + "?immutable=1", uri=True, check_same_thread=False)
+	return db
+
+
+def latestFilter(created, prefix):
+	# a prefix becomes a range on the primary key so only that subtree is read
+	conditions = []
+	params = []
+	if created is not None:
+		conditions.append("backup <= ?")
+		params.append(created)
+	if prefix:
+		conditions.append("path >= ? AND path < ?")
+		params.extend((prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+	if len(conditions) == 0:
+		return "", params
+	return " WHERE " + " AND ".join(conditions), params
+
+
+def fileEntry(digest, edited, size, mtime, chunks=None, codec=None, storedSize=None, pack=None, packOffset=None):
+	entry = {"hash": digest, "edited": edited}
+	if size is not None:
+		entry["size"] = size
+	if mtime is not None:
+		entry["mtime"] = mtime
+	if chunks is not None:
+		if isinstance(chunks, str):
+			chunks = chunks.split()
+		entry["chunks"] = chunks
+	if codec is not None:
+		entry["codec"] = codec
+	if storedSize is not None:
+		entry["storedSize"] = storedSize
+	if pack is not None:
+		entry["pack"] = pack
+		entry["packOffset"] = packOffset
+	return entry
+
+
+def fileRow(path, created, entry):
+	chunks = entry.get("chunks")
+	if chunks is not None:
+		chunks = " ".join(chunks)
+	return (path, created, entry["hash"], entry["edited"], entry.get("size"), entry.get("mtime"), chunks, entry.get("codec"), entry.get("storedSize"),
+	        entry.get("pack"), entry.get("packOffset"))
@@ -0,0 +1,67 @@
+import json
+import os
+from threading import Lock
+from codi.target import TARGET
+
+NAME = "CODIBackup_checkpoint.jsonl"
+
+
+class Checkpoint():
+	# entries of an unfinished backup whose data is on the target already, appended so a crashed backup can be resumed
+	def __init__(self, folder):
+		self.path = folder.join(NAME, False)
+		self.fd = None
+		self.lock = Lock()
+
+	def exists(self):
+		return self.path.exists()
+
+	def read(self):
+		# returns the recorded entries by path, a torn last line of a crash is cut off
+		files = {}
+		if not self.path.exists():
+			return files
+		valid = 0
+		with open(self.path.path, "rb") as fd:
+			for line in fd:
+				if not line.endswith(b"\n"):
+					break
+				try:
+					path, entry = json.loads(line)
+				except ValueError:
+					break
+				files[path] = entry
+				valid += len(line)
+		os.truncate(self.path.path, valid)
+		return files
+
+	def create(self):
+		# an empty checkpoint already marks the backup as resumable
+		with self.lock:
+			self.open()
+
+	def open(self):
+		if self.fd is None:
+			self.fd = open(self.path.path, "a", encoding="utf-8")
+			TARGET.fsync(self.fd.fileno())
+			TARGET.written(self.path.path)
+
+	def append(self, entries):
+		if len(entries) == 0:
+			return
+		with self.lock:
+			self.open()
+			for path, entry in entries:
+				self.fd.write(json.dumps([path, entry]) + "\n")
+			self.fd.flush()
+			TARGET.fsync(self.fd.fileno())
+
+	def close(self):
+		if self.fd is not None:
+			self.fd.close()
+			self.fd = None
+
+	def remove(self):
+		self.close()
+		if self.path.exists():
+			self.path.rm()
@@ -0,0 +1,58 @@
+import hashlib
+
+# gear hash with a one bit gear value per byte: a cut point is where the last n gear values are all set,
+# so finding it is a substring search over the translated data instead of a loop over every byte
+GEAR = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+
+
+class Chunker():
+	# content defined chunking with normalised chunk sizes like FastCDC
+	def __init__(self, averageSize):
+		self.minSize = averageSize // 4
+		self.normalSize = averageSize
+		self.maxSize = averageSize * 8
+		bits = max(averageSize.bit_length() - 3, 4)
+		# stricter before the average size, looser after it
+		self.strict = b"\x01" * (bits + 2)
+		self.loose = b"\x01" * (bits - 2)
+
+	def cutPoint(self, gears, start, end, final):
+		# returns the length of the next chunk of gears[start:end], None if more data is needed
+		length = end - start
+		if length == 0:
+			return 0 if final else None
+		if length <= self.minSize:
+			return length if final else None
+		position = gears.find(self.strict, start + max(self.minSize - len(self.strict), 0), start + min(length, self.normalSize))
+		if position >= 0:
+			return position + len(self.strict) - start
+		if length < self.normalSize:
+			return length if final else None
+		position = gears.find(self.loose, start + self.normalSize - len(self.loose) + 1, start + min(length, self.maxSize))
+		if position >= 0:
+			return position + len(self.loose) - start
+		if length >= self.maxSize:
+			return self.maxSize
+		return length if final else None
+
+	def chunks(self, fd, bufferSize=1024 * 1024):
+		# yields the chunks of the file object fd
+		data = b""
+		gears = b""
+		start = 0
+		final = False
+		while True:
+			cut = self.cutPoint(gears, start, len(data), final)
+			if cut is None:
+				block = fd.read(max(bufferSize, self.maxSize))
+				if not block:
+					final = True
+					continue
+				data = data[start:] + block
+				gears = gears[start:] + block.translate(GEAR)
+				start = 0
+				continue
+			if cut == 0:
+				return
+			yield data[start:start + cut]
+			start += cut
@@ -0,0 +1,85 @@
+import zlib
+import lzma
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+CODECS = ["zlib", "lzma", "zstd"]
+# formats that are compressed already, the offset of the magic bytes first
+MAGIC = [
+    (0, b"\x1f\x8b"),  # gzip
+    (0, b"PK\x03\x04"),  # zip, jar, docx, odt
+    (0, b"\xfd7zXZ\x00"),  # xz
+    (0, b"\x28\xb5\x2f\xfd"),  # zstd
+    (0, b"BZh"),  # bzip2
+    (0, b"7z\xbc\xaf\x27\x1c"),  # 7z
+    (0, b"Rar!"),  # rar
+    (0, b"\xff\xd8\xff"),  # jpeg
+    (0, b"\x89PNG"),  # png
+    (0, b"GIF8"),  # gif
+    (0, b"OggS"),  # ogg
+    (0, b"fLaC"),  # flac
+    (0, b"ID3"),  # mp3
+    (0, b"\x1aE\xdf\xa3"),  # mkv, webm
+    (4, b"ftyp"),  # mp4, mov, heic
+    (8, b"WEBP"),  # webp
+]
+
+
+def available(codec):
+	if codec == "zstd":
+		return zstandard is not None
+	return codec in CODECS
+
+
+def isCompressed(data):
+	for offset, magic in MAGIC:
+		if data[offset:offset + len(magic)] == magic:
+			return True
+	return False
+
+
+def compressor(codec, level=None):
+	if codec == "zlib":
+		return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level)
+	if codec == "lzma":
+		return lzma.LZMACompressor(preset=level)
+	if codec == "zstd":
+		return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+	raise ValueError("unknown codec " + str(codec))
+
+
+def compress(codec, data, level=None):
+	c = compressor(codec, level)
+	return c.compress(data) + c.flush()
+
+
+def worthCompressing(codec, sample, level=None):
+	# the sample is the first block of the data, it has to shrink by a tenth at least
+	if len(sample) == 0 or isCompressed(sample):
+		return False
+	return len(compress(codec, sample, level)) < len(sample) * 0.9
+
+
+class Decompressor():
+	def __init__(self, codec):
+		if codec == "zlib":
+			self.decompressor = zlib.decompressobj()
+		elif codec == "lzma":
+			self.decompressor = lzma.LZMADecompressor()
+		elif codec == "zstd":
+			if zstandard is None:
+				raise ValueError("zstd needs the zstandard module")
+			self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+		else:
+			raise ValueError("unknown codec " + str(codec))
+		self.codec = codec
+
+	def decompress(self, data):
+		return self.decompressor.decompress(data)
+
+	def flush(self):
+		if self.codec == "zlib":
+			return self.decompressor.flush()
+		return b""
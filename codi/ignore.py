@@ -0,0 +1,87 @@
+import re
+from pathlib import PurePosixPath
+
+WILDCARDS = "*?["
+
+
+class IgnoreMatcher():
+	# answers PurePath(path).match(pattern) for a list of patterns at once
+	def __init__(self, patterns):
+		self.names = set()
+		self.suffixes = []
+		self.paths = set()
+		expressions = []
+		for pattern in patterns:
+			parts = PurePosixPath(pattern).parts
+			if len(parts) == 0:
+				raise ValueError("empty pattern")
+			if not any(c in part for part in parts for c in WILDCARDS):
+				if len(parts) == 1:
+					self.names.add(parts[0])
+					continue
+				if parts[0] == "/":
+					self.paths.add(str(PurePosixPath(pattern)))
+					continue
+			if len(parts) == 1 and parts[0].startswith("*") and not any(c in parts[0][1:] for c in WILDCARDS):
+				self.suffixes.append(parts[0][1:])
+				continue
+			expressions.append(translate(parts))
+		self.suffixes = tuple(self.suffixes)
+		self.expression = None
+		if len(expressions) > 0:
+			self.expression = re.compile("|".join(expressions), re.DOTALL)
+
+	def match(self, path):
+		# path is normalised and absolute, folders may end with a separator
+		if len(path) > 1:
+			path = path.rstrip("/")
+		name = path[path.rfind("/") + 1:] or path
+		if name in self.names or name.endswith(self.suffixes) or path in self.paths:
+			return True
+		if self.expression is None:
+			return False
+		# parts are separated by \0 so the root "/" stays a part of its own like in PurePath.parts
+		if path == "/":
+			return self.expression.match("/") is not None
+		return self.expression.match("/\0" + path[1:].replace("/", "\0")) is not None
+
+
+def translate(parts):
+	# absolute patterns match all parts, relative ones the last parts
+	if parts[0] == "/":
+		return "(?:/" + "".join("\0" + translatePart(part) for part in parts[1:]) + ")\\Z"
+	return "(?:(?:.*\0)?" + "\0".join(translatePart(part) for part in parts) + ")\\Z"
+
+
+def translatePart(part):
+	# like fnmatch.translate, but wildcards never cross a part
+	ret = ""
+	i = 0
+	while i < len(part):
+		c = part[i]
+		i += 1
+		if c == "*":
+			ret += "[^\0]*"
+		elif c == "?":
+			ret += "[^\0]"
+		elif c == "[":
+			j = i
+			if j < len(part) and part[j] == "!":
+				j += 1
+			if j < len(part) and part[j] == "]":
+				j += 1
+			while j < len(part) and part[j] != "]":
+				j += 1
+			if j >= len(part):
+				ret += "\\["
+				continue
+			chars = part[i:j].replace("\\", "\\\\")
+			i = j + 1
+			if chars.startswith("!"):
+				chars = "^" + chars[1:]
+			elif chars.startswith("^"):
+				chars = "\\" + chars
+			ret += "(?!\0)[" + chars + "]"
+		else:
+			ret += re.escape(c)
+	return ret
@@ -0,0 +1,231 @@
+import struct
+import sys
+
+# a file is a single bytes object: the hash as 32 bytes, size, mtime and the times of its change and its backup as integers,
+# tombstones have a hash of zeros, fields most files lack are kept in the extras of their folder
+RECORD = struct.Struct("<32sqqqq")
+NONE = -2**63
+ZERO = bytes(32)
+
+
+class Node():
+	# folder of the prefix tree, every path component is stored once
+	__slots__ = ("files", "extras", "folders", "exists", "backup")
+
+	def __init__(self):
+		self.files = {}
+		self.extras = None
+		self.folders = {}
+		self.exists = None
+		self.backup = None
+
+	def setFile(self, name, entry, created):
+		record, extra = packEntry(entry, created)
+		self.files[name] = record
+		if extra is not None:
+			if self.extras is None:
+				self.extras = {}
+			self.extras[name] = extra
+		elif self.extras is not None:
+			self.extras.pop(name, None)
+
+	def removeFile(self, name):
+		del self.files[name]
+		if self.extras is not None:
+			self.extras.pop(name, None)
+
+	def isLive(self, name):
+		if self.extras is not None and "hash" in self.extras.get(name, ()):
+			return self.extras[name]["hash"] != ""
+		return self.files[name][:32] != ZERO
+
+	def getFile(self, name):
+		extra = None
+		if self.extras is not None:
+			extra = self.extras.get(name)
+		return unpackEntry(self.files[name], extra)
+
+
+class PathIndex():
+	# newest state of every file and folder over all backups
+	def __init__(self):
+		self.root = Node()
+
+	def clear(self):
+		self.root = Node()
+
+	def addBackup(self, backup):
+		created = backup["created"]
+		for file, entry in backup["files"].items():
+			self.addFile(file, entry, created)
+		for folder, exists in backup["folders"].items():
+			self.addFolder(folder, exists, created)
+
+	def addFile(self, path, entry, created):
+		folder, name = splitPath(path)
+		self.node(folder, True).setFile(sys.intern(name), entry, created)
+
+	def addFolder(self, path, exists, created):
+		node = self.node(path, True)
+		node.exists = exists
+		node.backup = packTime(created)
+
+	def merge(self, update, base, dropTombstones):
+		updateCreated = packTime(update["created"])
+		for file, entry in update["files"].items():
+			folder, name = splitPath(file)
+			node = self.node(folder)
+			record = None if node is None else node.files.get(name)
+			if record is not None and RECORD.unpack(record)[4] == updateCreated:
+				if dropTombstones and entry["hash"] == "":
+					node.removeFile(name)
+				else:
+					# the merge may have stored the file at another place in base
+					node.setFile(name, base["files"][file], base["created"])
+		for folder, exists in update["folders"].items():
+			node = self.node(folder)
+			if node is not None and node.exists is not None and node.backup == updateCreated:
+				if dropTombstones and not exists:
+					node.exists = None
+					node.backup = None
+				else:
+					node.backup = packTime(base["created"])
+
+	def node(self, folder, create=False):
+		node = self.root
+		for part in folder.split("/"):
+			if part == "":
+				continue
+			child = node.folders.get(part)
+			if child is None:
+				if not create:
+					return None
+				child = Node()
+				node.folders[sys.intern(part)] = child
+			node = child
+		return node
+
+	def getFile(self, path):
+		folder, name = splitPath(path)
+		node = self.node(folder)
+		if node is None or name not in node.files:
+			return None
+		return node.getFile(name)
+
+	def getFolder(self, path):
+		node = self.node(path)
+		if node is None or node.exists is None:
+			return None
+		return {"exists": node.exists, "backup": unpackTime(node.backup)}
+
+	def filesUnder(self, prefix=""):
+		# (path, entry) of every file whose path starts with prefix, ordered by path
+		folder, rest = splitPath(prefix)
+		node = self.node(folder)
+		if node is None:
+			return
+		for path, parent, name in walk(node, folder or "/", rest):
+			if name is not None:
+				yield path, parent.getFile(name)
+
+	def foldersUnder(self, prefix=""):
+		folder, rest = splitPath(prefix)
+		node = self.node(folder)
+		if node is None:
+			return
+		if rest == "" and node.exists is not None:
+			yield folder or "/", {"exists": node.exists, "backup": unpackTime(node.backup)}
+		for path, child, name in walk(node, folder or "/", rest):
+			if name is None and child.exists is not None:
+				yield path, {"exists": child.exists, "backup": unpackTime(child.backup)}
+
+	def liveFiles(self, prefix=""):
+		# paths of the files below prefix that are not deleted, without building their entries
+		folder, rest = splitPath(prefix)
+		node = self.node(folder)
+		if node is None:
+			return
+		for path, parent, name in walk(node, folder or "/", rest):
+			if name is not None and parent.isLive(name):
+				yield path
+
+	def liveFolders(self, prefix=""):
+		for path, entry in self.foldersUnder(prefix):
+			if entry["exists"]:
+				yield path
+
+
+def walk(node, path, rest=""):
+	# (path, node, None) for folders and (path, node of its folder, name) for files below node in path order,
+	# the names of the first level start with rest
+	children = [(name, name) for name in node.files if name.startswith(rest)]
+	children += [(name + "/", None) for name in node.folders if name.startswith(rest)]
+	children.sort(key=lambda child: child[0])
+	for key, name in children:
+		if name is not None:
+			yield path + key, node, name
+		else:
+			child = node.folders[key[:-1]]
+			yield path + key, child, None
+			yield from walk(child, path + key)
+
+
+def packEntry(entry, created):
+	# (record, extra) of an entry, extra holds what the record cannot
+	extra = {key: value for key, value in entry.items() if key not in ("hash", "edited", "size", "mtime", "backup")}
+	digest = packHash(entry["hash"])
+	if not isinstance(digest, bytes):
+		extra["hash"] = entry["hash"]
+		digest = ZERO
+	edited = 0 if entry["edited"] == "" else packTime(entry["edited"])
+	if not isinstance(edited, int):
+		extra["edited"] = entry["edited"]
+		edited = 0
+	size = entry.get("size")
+	mtime = entry.get("mtime")
+	record = RECORD.pack(digest, NONE if size is None else size, NONE if mtime is None else mtime, edited, packTime(created))
+	return record, extra or None
+
+
+def unpackEntry(record, extra):
+	digest, size, mtime, edited, backup = RECORD.unpack(record)
+	ret = {"hash": "" if digest == ZERO else digest.hex(), "edited": unpackTime(edited) if edited != 0 else ""}
+	if size != NONE:
+		ret["size"] = size
+	if mtime != NONE:
+		ret["mtime"] = mtime
+	if extra is not None:
+		ret.update(extra)
+	ret["backup"] = unpackTime(backup)
+	return ret
+
+
+def splitPath(path):
+	# folder with its trailing separator and the name of the last component
+	i = path.rfind("/")
+	return path[:i + 1], path[i + 1:]
+
+
+def packHash(digest):
+	if digest == "":
+		return ZERO
+	if len(digest) == 64:
+		try:
+			return bytes.fromhex(digest)
+		except ValueError:
+			pass
+	return digest
+
+
+def packTime(timestring):
+	# 20240131T235959 becomes 20240131235959
+	if len(timestring) == 15 and timestring[8] == "T" and timestring[:8].isdigit() and timestring[9:].isdigit():
+		return int(timestring[:8] + timestring[9:])
+	return timestring
+
+
+def unpackTime(time):
+	if isinstance(time, int):
+		time = "%014d" % time
+		return time[:8] + "T" + time[8:]
+	return time
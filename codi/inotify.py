@@ -0,0 +1,58 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_CHANGES = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct("iIII")
+
+
+class Inotify():
+	def __init__(self):
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+
+	def addWatch(self, path, mask=IN_CHANGES | IN_ONLYDIR):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno), path)
+		return wd
+
+	def read(self, timeout=None):
+		# returns a list of (wd, mask, cookie, name), empty if nothing happened within timeout seconds
+		if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+			return []
+		data = os.read(self.fd, 1024 * 1024)
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+			offset += EVENT.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+			offset += length
+			events.append((wd, mask, cookie, name))
+		return events
+
+	def close(self):
+		return os.close(self.fd)
@@ -1,7 +1,19 @@
 import os.path
 import shutil
+import hashlib
+import tempfile
+from stat import S_ISDIR
 import json
 import datetime
+import fcntl
+from codi.codec import compressor, worthCompressing, Decompressor
+from codi.target import TARGET
+from codi.throttle import THROTTLE
+
+FICLONE = 0x40049409
+# the umask can only be read by setting it, so it is read once at import before other threads create files
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 class Path():
@@ -88,6 +100,25 @@ class Path():
 					ret.append(Path(path, True))
 		return ret
 
+	def scandir(self):
+		ret = []
+		with os.scandir(self.path) as it:
+			for entry in it:
+				if entry.is_dir():
+					ret.append(Entry(entry.path + os.sep, True))
+				elif entry.is_file():
+					ret.append(Entry(entry.path, False, entry.stat()))
+		return ret
+
+	def entry(self):
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return None
+		if S_ISDIR(stat.st_mode):
+			return Entry(self.path if self.isFolder else self.path + os.sep, True, stat)
+		return Entry(self.path, False, stat)
+
 	def basename(self):
 		if self.path[-1] == os.sep:
 			return os.path.basename(self.path[:-1]) + os.sep
@@ -105,28 +136,269 @@ class Path():
 				dst.mkdir()
 			return shutil.copytree(self.path, dst.path)
 		else:
-			parentDir = dst.parent()
-			if not parentDir.exists():
-				parentDir.mkdir()
+			dst.parent().mkdir()
 		return shutil.copy2(self.path, dst.path)
 
+	def cpFast(self, dst, codec=None):
+		# copies without passing the data through userspace where the filesystems allow it, decompresses codec
+		parentDir = dst.parent()
+		parentDir.mkdir()
+		fd, tmpPath = tempfile.mkstemp(prefix=".CODIBackup_", suffix=".tmp", dir=parentDir.path)
+		try:
+			with open(self.path, "rb", buffering=0) as src, open(fd, "wb", buffering=0) as tmp:
+				if codec is None:
+					copyData(src.fileno(), tmp.fileno())
+				else:
+					decodeData(src, tmp, codec)
+			shutil.copystat(self.path, tmpPath)
+			os.replace(tmpPath, dst.path)
+		except BaseException:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+
+	def assemble(self, parts):
+		# writes the concatenation of parts, pairs of a path and its codec, to self
+		parentDir = self.parent()
+		parentDir.mkdir()
+		fd, tmpPath = tempfile.mkstemp(prefix=".CODIBackup_", suffix=".tmp", dir=parentDir.path)
+		try:
+			with open(fd, "wb", buffering=0) as tmp:
+				for part, codec in parts:
+					with open(part.path, "rb", buffering=0) as src:
+						if codec is None:
+							copyData(src.fileno(), tmp.fileno(), False)
+						else:
+							decodeData(src, tmp, codec)
+			replaceMode(tmpPath, self.path)
+			os.replace(tmpPath, self.path)
+		except BaseException:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+
+	def writeAtomic(self, data, tmpDir=None):
+		parentDir = tmpDir
+		if parentDir is None:
+			parentDir = self.parent()
+		parentDir.mkdir()
+		fd, tmpPath = tempfile.mkstemp(prefix=".CODIBackup_", suffix=".tmp", dir=parentDir.path)
+		try:
+			with open(fd, "wb") as tmp:
+				tmp.write(data)
+				tmp.flush()
+				TARGET.fsync(tmp.fileno())
+			self.parent().mkdir()
+			replaceMode(tmpPath, self.path)
+			os.replace(tmpPath, self.path)
+			TARGET.written(self.path)
+		except BaseException:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+
 	def mv(self, dst):
 		if self.isdir():
 			if not dst.exists():
 				dst.mkdir()
 		else:
-			parentDir = dst.parent()
-			if not parentDir.exists():
-				parentDir.mkdir()
-		return shutil.move(self.path, dst.path)
+			dst.parent().mkdir()
+		ret = shutil.move(self.path, dst.path)
+		TARGET.written(self.path)
+		TARGET.written(dst.path)
+		return ret
 
 	def rm(self):
+		TARGET.written(self.path)
 		if self.isdir():
+			TARGET.forget()
 			return shutil.rmtree(self.path)
 		return os.remove(self.path)
 
 	def mkdir(self):
-		return os.makedirs(self.path)
+		path = self.path
+		if path[-1] != os.sep:
+			path += os.sep
+		return TARGET.makedirs(path)
+
+	def readAt(self, offset, size):
+		with open(self.path, "rb", buffering=0) as fd:
+			return os.pread(fd.fileno(), size, offset)
+
+	def blocks(self, bufferSize=1024 * 1024):
+		with open(self.path, "rb") as fd:
+			while True:
+				data = fd.read(bufferSize)
+				if not data:
+					break
+				THROTTLE.reading(len(data))
+				yield data
+
+	def decodedBlocks(self, codec=None, bufferSize=1024 * 1024):
+		# the content of a file stored compressed with codec
+		decompressor = None if codec is None else Decompressor(codec)
+		for data in self.blocks(bufferSize):
+			yield data if decompressor is None else decompressor.decompress(data)
+		if decompressor is not None:
+			yield decompressor.flush()
+
+	def willNeed(self):
+		# lets the kernel read the file ahead while other files are still processed
+		fd = os.open(self.path, os.O_RDONLY)
+		try:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+		finally:
+			os.close(fd)
+
+	def sha256(self, bufferSize=1024 * 1024):
+		sha256 = hashlib.sha256()
+		for data in self.blocks(bufferSize):
+			sha256.update(data)
+		return sha256.hexdigest()
+
+	def cpHashed(self, dst, bufferSize=1024 * 1024, storedHash="", tmpDir=None, codec=None, level=None):
+		# dst may be a function mapping the calculated hash and codec to the destination and its codec (an existing path if it is already stored)
+		# codec is dropped if the first block does not compress, returns (hash, changed, codec, stored size)
+		parentDir = tmpDir
+		if parentDir is None:
+			parentDir = dst.parent()
+		parentDir.mkdir()
+		sha256 = hashlib.sha256()
+		buffer = bytearray(bufferSize)
+		view = memoryview(buffer)
+		fd, tmpPath = tempfile.mkstemp(prefix=".CODIBackup_", suffix=".tmp", dir=parentDir.path)
+		try:
+			with open(self.path, "rb", buffering=0) as src, open(fd, "wb", buffering=0) as tmp:
+				encoder = None
+				first = True
+				while True:
+					size = src.readinto(buffer)
+					if not size:
+						break
+					THROTTLE.reading(size)
+					sha256.update(view[:size])
+					if first:
+						first = False
+						if codec is not None and worthCompressing(codec, view[:size], level):
+							encoder = compressor(codec, level)
+						else:
+							codec = None
+					data = view[:size] if encoder is None else encoder.compress(view[:size])
+					THROTTLE.writing(len(data))
+					writeAll(tmp, data)
+				if encoder is not None:
+					data = encoder.flush()
+					THROTTLE.writing(len(data))
+					writeAll(tmp, data)
+				TARGET.fsync(tmp.fileno())
+			if first:
+				codec = None
+			calculatedHash = sha256.hexdigest()
+			if calculatedHash == storedHash:
+				os.remove(tmpPath)
+				return calculatedHash, False, codec, None
+			storedSize = os.path.getsize(tmpPath)
+			if callable(dst):
+				dst, codec = dst(calculatedHash, codec)
+				if dst.exists():
+					os.remove(tmpPath)
+					return calculatedHash, True, codec, dst.getsize()
+				dst.parent().mkdir()
+			shutil.copystat(self.path, tmpPath)
+			os.replace(tmpPath, dst.path)
+			TARGET.written(dst.path)
+		except BaseException:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+		return calculatedHash, True, codec, storedSize
+
+
+def replaceMode(tmpPath, path):
+	# mkstemp creates files only the owner can read, the file replacing path keeps its mode or gets the one of a new file
+	try:
+		mode = os.stat(path).st_mode & 0o7777
+	except FileNotFoundError:
+		mode = 0o666 & ~UMASK
+	os.chmod(tmpPath, mode)
+
+
+def copyData(srcFd, dstFd, clone=True):
+	# clone replaces the whole destination, so appending callers pass clone=False
+	if clone:
+		try:
+			fcntl.ioctl(dstFd, FICLONE, srcFd)
+			return
+		except OSError:
+			pass
+	start = os.lseek(dstFd, 0, os.SEEK_CUR)
+	copied = 0
+	for method in ["copy_file_range", "sendfile"]:
+		if not hasattr(os, method):
+			continue
+		try:
+			while True:
+				if method == "copy_file_range":
+					size = os.copy_file_range(srcFd, dstFd, 1 << 30)
+				else:
+					size = os.sendfile(dstFd, srcFd, None, 1 << 30)
+				if size == 0:
+					return
+				copied += size
+		except OSError:
+			os.lseek(srcFd, copied, os.SEEK_SET)
+			os.lseek(dstFd, start + copied, os.SEEK_SET)
+	while True:
+		data = os.read(srcFd, 1024 * 1024)
+		if not data:
+			return
+		view = memoryview(data)
+		while len(view) > 0:
+			view = view[os.write(dstFd, view):]
+
+
+def decodeData(src, dst, codec, bufferSize=64 * 1024):
+	# small reads bound the memory a highly compressed block expands to
+	decompressor = Decompressor(codec)
+	while True:
+		data = src.read(bufferSize)
+		if not data:
+			break
+		writeAll(dst, decompressor.decompress(data))
+	writeAll(dst, decompressor.flush())
+
+
+def writeAll(fd, data):
+	# unbuffered files may write less than asked for
+	view = memoryview(data)
+	while len(view) > 0:
+		view = view[fd.write(view):]
+
+
+class Entry(Path):
+	# path with the stat result of the directory scan that found it, folders are not stat'ed
+	def __init__(self, path, isFolder, stat=None):
+		self.path = path
+		self.isFolder = isFolder
+		self.size = None
+		self.mtime = None
+		self.inode = None
+		self.mode = None
+		if stat is not None:
+			self.size = stat.st_size
+			self.mtime = stat.st_mtime_ns
+			self.inode = stat.st_ino
+			self.mode = stat.st_mode
+
+	def getmtime(self):
+		if self.mtime is None:
+			return super().getmtime()
+		return datetime.datetime.fromtimestamp(self.mtime // 1000000000)
+
+	def getsize(self):
+		if self.size is None:
+			return super().getsize()
+		return self.size
 
 
 class File():
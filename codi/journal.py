@@ -0,0 +1,95 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+SINCE = "!since "
+OVERFLOW = "!overflow"
+
+
+class Journal():
+	# paths changed since the last backup, appended by the watcher and consumed by the backup
+	def __init__(self, path):
+		self.path = path
+		self.watchFd = None
+
+	@contextmanager
+	def lock(self):
+		fd = os.open(self.path.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			yield
+		finally:
+			os.close(fd)
+
+	def acquireWatch(self):
+		fd = os.open(self.path.path + ".watch", os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			os.close(fd)
+			return False
+		self.watchFd = fd
+		return True
+
+	def isWatched(self):
+		if self.watchFd is not None:
+			return True
+		fd = os.open(self.path.path + ".watch", os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+		except BlockingIOError:
+			return True
+		finally:
+			os.close(fd)
+		return False
+
+	def start(self, since):
+		with self.lock():
+			self.rewrite([SINCE + since + "\n"])
+
+	def append(self, paths):
+		with self.lock():
+			with open(self.path.path, "a", encoding="utf-8") as fd:
+				for path in paths:
+					fd.write(json.dumps(path) + "\n")
+
+	def overflow(self):
+		with self.lock():
+			with open(self.path.path, "a", encoding="utf-8") as fd:
+				fd.write(OVERFLOW + "\n")
+
+	def read(self):
+		# returns (since, overflowed, paths, number of lines read) or None without a journal
+		with self.lock():
+			if not self.path.exists():
+				return None
+			with open(self.path.path, "r", encoding="utf-8") as fd:
+				lines = fd.readlines()
+		since = None
+		overflowed = False
+		paths = set()
+		for line in lines:
+			if line.startswith(SINCE):
+				since = line[len(SINCE):].strip()
+			elif line.startswith(OVERFLOW):
+				overflowed = True
+			elif line.endswith("\n"):
+				paths.add(json.loads(line))
+		return since, overflowed, paths, len(lines)
+
+	def consume(self, count):
+		with self.lock():
+			if not self.path.exists():
+				return
+			with open(self.path.path, "r", encoding="utf-8") as fd:
+				lines = fd.readlines()
+			self.rewrite([line for line in lines[:count] if line.startswith(SINCE)] + lines[count:])
+
+	def rewrite(self, lines):
+		tmpPath = self.path.path + ".tmp"
+		with open(tmpPath, "w", encoding="utf-8") as fd:
+			fd.writelines(lines)
+			fd.flush()
+			os.fsync(fd.fileno())
+		os.replace(tmpPath, self.path.path)
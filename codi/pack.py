@@ -0,0 +1,59 @@
+from threading import Lock
+from codi.target import TARGET
+
+SUFFIX = ".pack"
+
+
+class PackWriter():
+	# appends small files to numbered pack files in folder, a new pack is started once a pack would exceed maxSize
+	def __init__(self, folder, maxSize):
+		self.folder = folder
+		self.maxSize = maxSize
+		self.lock = Lock()
+		self.fd = None
+		self.name = None
+		self.offset = 0
+		self.number = 0
+		self.written = set()
+		for f in folder.listdir():
+			name = f.basename()
+			if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit():
+				self.number = max(self.number, int(name[:-len(SUFFIX)]) + 1)
+
+	def append(self, data):
+		# returns the name of the pack and the offset data was written to
+		with self.lock:
+			if self.fd is None or (self.offset > 0 and self.offset + len(data) > self.maxSize):
+				self.next()
+			offset = self.offset
+			self.fd.write(data)
+			self.offset += len(data)
+			return self.name, offset
+
+	def next(self):
+		self.closePack()
+		self.folder.mkdir()
+		self.name = str(self.number) + SUFFIX
+		self.number += 1
+		self.fd = open(self.folder.join(self.name, False).path, "wb")
+		self.offset = 0
+		self.written.add(self.name)
+
+	def sync(self):
+		# makes everything appended so far durable
+		with self.lock:
+			if self.fd is not None:
+				self.fd.flush()
+				TARGET.fsync(self.fd.fileno())
+
+	def closePack(self):
+		if self.fd is not None:
+			self.fd.flush()
+			TARGET.fsync(self.fd.fileno())
+			self.fd.close()
+			self.fd = None
+			TARGET.written(self.folder.join(self.name, False).path)
+
+	def close(self):
+		with self.lock:
+			self.closePack()
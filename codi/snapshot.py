@@ -0,0 +1,204 @@
+import io
+from codi.codec import Decompressor
+
+
+class SnapshotView():
+	# read-only file system of the state at backup created, folders are listed from the catalog when they are accessed;
+	# parts(path, entry) returns where the content of a file is stored as [(Path, codec, offset, size)]
+	def __init__(self, catalog, created, parts):
+		self.catalog = catalog
+		self.created = created
+		self.parts = parts
+
+	def entry(self, path):
+		# entry of the file at path with the backup storing it, None if there is no such file
+		latest = self.catalog.latestFile(path, self.created)
+		if latest is None or latest[0]["hash"] == "":
+			return None
+		entry, backup = latest
+		entry["backup"] = backup
+		return entry
+
+	def isdir(self, path):
+		folder = folderPath(path)
+		if folder == "/":
+			return True
+		latest = self.catalog.latestFolder(folder, self.created)
+		return latest is not None and latest[0]
+
+	def isfile(self, path):
+		return self.entry(path) is not None
+
+	def exists(self, path):
+		return self.isfile(path) or self.isdir(path)
+
+	def stat(self, path):
+		# the entry of a file, folders only tell the backup that recorded them
+		entry = self.entry(path)
+		if entry is not None:
+			return entry
+		folder = folderPath(path)
+		latest = self.catalog.latestFolder(folder, self.created)
+		if latest is not None and latest[0]:
+			return {"folder": True, "backup": latest[1]}
+		if folder == "/":
+			return {"folder": True, "backup": self.created}
+		raise FileNotFoundError(path)
+
+	def listdir(self, path):
+		# names of the files and folders in folder path, sorted
+		folder = folderPath(path)
+		if not self.isdir(folder):
+			if self.isfile(path):
+				raise NotADirectoryError(path)
+			raise FileNotFoundError(path)
+		names = []
+		for file, entry, backup in self.catalog.childFiles(folder, self.created):
+			if entry["hash"] != "":
+				names.append(file[len(folder):])
+		for child, present, backup in self.catalog.childFolders(folder, self.created):
+			if present:
+				names.append(child[len(folder):-1])
+		return sorted(names)
+
+	def scandir(self, path):
+		# (name, entry) of everything in folder path, entry is None for folders
+		folder = folderPath(path)
+		if not self.isdir(folder):
+			raise FileNotFoundError(path)
+		ret = []
+		for file, entry, backup in self.catalog.childFiles(folder, self.created):
+			if entry["hash"] != "":
+				entry["backup"] = backup
+				ret.append((file[len(folder):], entry))
+		for child, present, backup in self.catalog.childFolders(folder, self.created):
+			if present:
+				ret.append((child[len(folder):-1], None))
+		return sorted(ret, key=lambda item: item[0])
+
+	def walk(self, top="/"):
+		# like os.walk, top down, every folder is listed when it is reached
+		folder = folderPath(top)
+		folders = []
+		files = []
+		for name, entry in self.scandir(folder):
+			if entry is None:
+				folders.append(name)
+			else:
+				files.append(name)
+		yield folder, folders, files
+		for name in folders:
+			yield from self.walk(folder + name + "/")
+
+	def open(self, path):
+		entry = self.entry(path)
+		if entry is None:
+			if self.isdir(path):
+				raise IsADirectoryError(path)
+			raise FileNotFoundError(path)
+		return SnapshotFile(self.parts(path, entry), entry.get("size"))
+
+	def read(self, path, offset=0, size=-1):
+		with self.open(path) as f:
+			return f.readAt(offset, size)
+
+
+class SnapshotFile(io.RawIOBase):
+	# content of a stored file; uncompressed parts are read at any offset, compressed ones are decoded from the start
+	def __init__(self, parts, size=None):
+		self.parts = parts
+		self.lengths = None
+		if all(codec is None for path, codec, offset, length in parts):
+			self.lengths = [path.getsize() if length is None else length for path, codec, offset, length in parts]
+		self.size = size
+		if self.size is None:
+			self.size = sum(self.lengths) if self.lengths is not None else sum(len(data) for data in partBlocks(parts))
+		self.position = 0
+		self.stream = None
+		self.streamPosition = 0
+		self.buffer = b""
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self.position
+		elif whence == io.SEEK_END:
+			offset += self.size
+		self.position = max(offset, 0)
+		return self.position
+
+	def tell(self):
+		return self.position
+
+	def read(self, size=-1):
+		data = self.readAt(self.position, size)
+		self.position += len(data)
+		return data
+
+	def readinto(self, buffer):
+		data = self.read(len(buffer))
+		buffer[:len(data)] = data
+		return len(data)
+
+	def readAt(self, offset, size=-1):
+		if size < 0 or offset + size > self.size:
+			size = max(self.size - offset, 0)
+		if size == 0:
+			return b""
+		if self.lengths is not None:
+			return self.readParts(offset, size)
+		return self.readStream(offset, size)
+
+	def readParts(self, offset, size):
+		ret = []
+		start = 0
+		for (path, codec, partOffset, length), partLength in zip(self.parts, self.lengths):
+			if offset < start + partLength and offset + size > start:
+				inner = max(offset - start, 0)
+				count = min(start + partLength, offset + size) - start - inner
+				ret.append(path.readAt((partOffset or 0) + inner, count))
+			start += partLength
+		return b"".join(ret)
+
+	def readStream(self, offset, size):
+		if self.stream is None or offset < self.streamPosition:
+			self.stream = partBlocks(self.parts)
+			self.streamPosition = 0
+			self.buffer = b""
+		# data before offset is decoded and dropped
+		while self.streamPosition + len(self.buffer) < offset + size:
+			block = next(self.stream, None)
+			if block is None:
+				break
+			if self.streamPosition + len(self.buffer) + len(block) <= offset:
+				self.streamPosition += len(self.buffer) + len(block)
+				self.buffer = b""
+			else:
+				self.buffer += block
+		skip = offset - self.streamPosition
+		data = self.buffer[skip:skip + size]
+		self.streamPosition += skip + len(data)
+		self.buffer = self.buffer[skip + len(data):]
+		return data
+
+
+def folderPath(path):
+	return path.rstrip("/") + "/"
+
+
+def partBlocks(parts, bufferSize=1024 * 1024):
+	# the decoded content of parts, one block after another
+	for path, codec, offset, size in parts:
+		if offset is None:
+			yield from path.decodedBlocks(codec, bufferSize)
+			continue
+		data = path.readAt(offset, size)
+		if codec is not None:
+			decompressor = Decompressor(codec)
+			data = decompressor.decompress(data) + decompressor.flush()
+		yield data
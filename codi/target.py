@@ -0,0 +1,102 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+
+class Target():
+	# file system operations on the backup target: every call is a round trip on remote file systems like sshfs,
+	# so created folders are remembered and writes and moves are queued until a barrier
+	def __init__(self):
+		self.lock = Lock()
+		self.folders = set()
+		self.touched = set()
+		self.sync = False
+		self.workers = 4
+		self.pool = None
+		self.slots = None
+		self.futures = []
+
+	def configure(self, sync, workers):
+		self.sync = sync
+		self.workers = workers
+
+	def makedirs(self, path):
+		if path in self.folders:
+			return
+		os.makedirs(path, exist_ok=True)
+		with self.lock:
+			while path not in self.folders and path != os.sep:
+				self.folders.add(path)
+				path = os.path.dirname(path.rstrip(os.sep)) + os.sep
+
+	def forget(self):
+		# after folders were removed, they have to be checked again
+		with self.lock:
+			self.folders.clear()
+
+	def fsync(self, fd):
+		if self.sync:
+			os.fsync(fd)
+
+	def written(self, path):
+		# the folder of a file that was created, renamed or removed has to be synced at the barrier
+		if self.sync:
+			with self.lock:
+				self.touched.add(os.path.dirname(path.rstrip(os.sep)))
+
+	def submit(self, function, *args):
+		# runs function in the background, at most four times the workers are outstanding
+		if self.pool is None:
+			self.pool = ThreadPoolExecutor(max_workers=self.workers)
+			self.slots = BoundedSemaphore(self.workers * 4)
+		self.slots.acquire()
+
+		def run():
+			try:
+				return function(*args)
+			finally:
+				self.slots.release()
+
+		try:
+			future = self.pool.submit(run)
+		except BaseException:
+			self.slots.release()
+			raise
+		with self.lock:
+			self.futures.append(future)
+		return future
+
+	def barrier(self):
+		# waits for all submitted operations and makes everything written so far durable
+		with self.lock:
+			futures = self.futures
+			self.futures = []
+		error = None
+		for future in futures:
+			try:
+				future.result()
+			except BaseException as e:
+				if error is None:
+					error = e
+		if error is not None:
+			raise error
+		with self.lock:
+			touched = self.touched
+			self.touched = set()
+		for folder in sorted(touched):
+			try:
+				fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+			except FileNotFoundError:
+				continue
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.shutdown(wait=True)
+			self.pool = None
+
+
+TARGET = Target()
@@ -0,0 +1,158 @@
+import os
+import time
+import ctypes
+import platform
+from threading import Lock
+
+PRESSURE = "/proc/pressure/io"
+# syscall numbers of ioprio_set, it has no wrapper in the C library
+IOPRIO_SET = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273, "s390x": 282, "riscv64": 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+
+
+class TokenBucket():
+	# allows rate units per second on average and bursts of up to burst units, shared between threads
+	def __init__(self, rate, burst=None):
+		self.rate = rate
+		self.burst = rate if burst is None else burst
+		self.tokens = self.burst
+		self.updated = time.monotonic()
+		self.lock = Lock()
+
+	def consume(self, amount):
+		# blocks until amount units are allowed, amounts above burst go into debt so large blocks work too
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= amount
+			wait = -self.tokens / self.rate
+		if wait > 0:
+			time.sleep(wait)
+
+
+class Throttle():
+	# limits the io of a running backup for all its threads: bytes read and written and read and write calls per second;
+	# with pressure set every call also waits while other tasks stalled on io for more than pressure percent of the time
+	def __init__(self):
+		self.lock = Lock()
+		self.readBucket = None
+		self.writeBucket = None
+		self.callBucket = None
+		self.pressure = 0
+		self.running = False
+		self.reset()
+
+	def configure(self, readRate=0, writeRate=0, iops=0, pressure=0):
+		self.readBucket = TokenBucket(readRate) if readRate > 0 else None
+		self.writeBucket = TokenBucket(writeRate) if writeRate > 0 else None
+		self.callBucket = TokenBucket(iops) if iops > 0 else None
+		self.pressure = pressure if pressure > 0 and stalled() is not None else 0
+
+	def start(self):
+		with self.lock:
+			self.reset()
+			self.running = True
+
+	def reset(self):
+		self.started = time.monotonic()
+		self.read = 0
+		self.written = 0
+		self.limited = 0.0
+		self.backedOff = 0.0
+		self.delay = 0.0
+		self.sampled = self.started
+		self.stalled = stalled() if self.pressure > 0 else None
+
+	def stop(self):
+		# what the run read and wrote and how long its threads waited for the limits and the io pressure in total
+		with self.lock:
+			self.running = False
+			return {"read": self.read, "written": self.written, "seconds": time.monotonic() - self.started, "limited": self.limited,
+			        "backedOff": self.backedOff}
+
+	def reading(self, amount):
+		self.consume(self.readBucket, amount, True)
+
+	def writing(self, amount):
+		self.consume(self.writeBucket, amount, False)
+
+	def consume(self, bucket, amount, read):
+		if not self.running or amount == 0:
+			return
+		started = time.monotonic()
+		if self.callBucket is not None:
+			self.callBucket.consume(1)
+		if bucket is not None:
+			bucket.consume(amount)
+		limited = time.monotonic() - started
+		delay = self.backOff()
+		with self.lock:
+			if read:
+				self.read += amount
+			else:
+				self.written += amount
+			self.limited += limited
+			self.backedOff += delay
+
+	def backOff(self):
+		# the delay doubles every second the pressure stays above the threshold and halves once it is below
+		if self.pressure == 0:
+			return 0
+		with self.lock:
+			now = time.monotonic()
+			if now - self.sampled >= 1:
+				total = stalled()
+				if total is not None and self.stalled is not None:
+					share = (total - self.stalled) / ((now - self.sampled) * 10000)
+					if share > self.pressure:
+						self.delay = min(max(self.delay * 2, 0.01), 1)
+					elif self.delay > 0.01:
+						self.delay /= 2
+					else:
+						self.delay = 0
+				self.stalled = total
+				self.sampled = now
+			delay = self.delay
+		if delay > 0:
+			time.sleep(delay)
+		return delay
+
+
+def stalled():
+	# microseconds some task waited for io since boot, None without pressure stall information
+	try:
+		with open(PRESSURE) as f:
+			for line in f:
+				if line.startswith("some "):
+					return int(line.split("total=")[1])
+	except (OSError, ValueError, IndexError):
+		pass
+	return None
+
+
+def lowerPriority(ioPriority, niceness):
+	# the io class ("idle" or "best-effort" with the lowest level) and the niceness of the calling thread and the threads it starts
+	if niceness != 0:
+		os.setpriority(os.PRIO_PROCESS, 0, niceness)
+	if not ioPriority:
+		return
+	number = IOPRIO_SET.get(platform.machine())
+	if number is None:
+		raise OSError("ioprio_set is not known on " + platform.machine())
+	if ioPriority == "idle":
+		value = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+	elif ioPriority == "best-effort":
+		value = IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT | 7
+	else:
+		raise ValueError("unknown ioPriority " + str(ioPriority))
+	libc = ctypes.CDLL(None, use_errno=True)
+	if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+		error = ctypes.get_errno()
+		raise OSError(error, os.strerror(error))
+
+
+THROTTLE = Throttle()
@@ -0,0 +1,74 @@
+import json
+import os
+import random
+from pathlib import PurePath
+import pytest
+from codi.ignore import IgnoreMatcher
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# patterns the translator handles specially
+EDGES = ["[!a]*", "[]]x", "[a-", "[!]]x", "[^a]x", "[a-c]b", "?", "*", "/x/y", "/x/*", "a/*.c", "*/lib/", "lib/", "/", "a\\b"]
+NAMES = [
+    "a", "b", "x", "y", "lib", "bin", ".git", "build", "doc", "nobackup", "__pycache__", "main.c", "a.c", "b.c", "notes.txt", "run.log", "data.sqlite",
+    ".x.swp", "mod.pyc", "mod.o", "libx.so", "libx.a", "src.zip", "src.tar", "src.tar.gz", "src.tgz", "]x", "[a-", "ab", "ba", "a b", "a\\b", "home",
+    "bla", "projects", "CODIBackup2", "testBackup"
+]
+
+
+def configPatterns():
+	ret = []
+	for name in ["config.json", ".config.json"]:
+		with open(os.path.join(ROOT, name)) as f:
+			ret += json.load(f)["ignore"]
+	return sorted(set(ret))
+
+
+def paths():
+	# normalised absolute paths, some folders end with a separator like the walker passes them
+	rng = random.Random(0)
+	ret = ["/", "/x/y", "/x/y/", "/z/x/y", "/lib", "/lib/", "/a/b.c", "/q/a/b.c", "/home/bla/projects/CODIBackup2/testBackup/",
+	       "/home/bla/projects/CODIBackup2/testBackup/x"]
+	for i in range(20000):
+		path = "/" + "/".join(rng.choice(NAMES) for j in range(rng.randint(1, 6)))
+		if rng.random() < 0.3:
+			path += "/"
+		ret.append(path)
+	return ret
+
+
+PATHS = paths()
+
+
+def expected(path, pattern):
+	try:
+		return PurePath(path).match(pattern)
+	except ValueError:
+		return ValueError
+
+
+def matched(path, pattern):
+	try:
+		return IgnoreMatcher([pattern]).match(path)
+	except ValueError:
+		return ValueError
+
+
+@pytest.mark.parametrize("pattern", configPatterns() + EDGES)
+def test_pattern(pattern):
+	matcher = IgnoreMatcher([pattern])
+	for path in PATHS:
+		assert matcher.match(path) == PurePath(path).match(pattern), path
+
+
+def test_patterns():
+	# a matcher of several patterns matches where any of them does
+	patterns = configPatterns()
+	matcher = IgnoreMatcher(patterns)
+	for path in PATHS:
+		assert matcher.match(path) == any(PurePath(path).match(pattern) for pattern in patterns), path
+
+
+@pytest.mark.parametrize("pattern", ["", "."])
+def test_empty(pattern):
+	assert expected("/a", pattern) is ValueError
+	assert matched("/a", pattern) is ValueError